@@ -2,73 +2,303 @@
 """
 ingest_conversations.py
 
-Ingest new CLI conversations from data/conversations.jsonl into the Chroma index,
+Ingest new CLI conversations from data/conversations.mpk into the Chroma index,
 so that future RAG queries can see your live interactions as part of memory.
+
+Logs from older versions (data/conversations.jsonl) are ingested to the end
+first; after that ingestion moves on to the msgpack log.
 """
 
-import json
+import hashlib
+import os
+import sqlite3
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-import yaml
+import msgpack
+import numpy as np
+import orjson
 import chromadb
 from chromadb.config import Settings
 from sentence_transformers import SentenceTransformer
 
-# Reuse config logic from llm_rag_cli if you want, but keep this standalone too.
-HERE = Path(__file__).resolve().parent
-DATA_DIR = HERE / "data"
-LOG_PATH = DATA_DIR / "conversations.jsonl"
-STATE_PATH = DATA_DIR / "conversations_ingest_state.json"
-CONFIG_PATH = HERE / "config.yaml"
+from brain_settings import CONFIG_PATH, ROOT, load_yaml, open_chroma_collection
+from rag_index import DEFAULT_ONNX_FILE, get_embedder
+
+# Paths are relative to the project root, where router/brain_api write the
+# log, not to _alpha/.
+DATA_DIR = ROOT / "data"
+# Framed msgpack records, as written by llm_rag_cli.encode_log_record():
+# marker, uint32 body length, uint32 CRC32 (little-endian), then the body.
+LOG_PATH = DATA_DIR / "conversations.mpk"
+LOG_MAGIC = b"LBR1"
+LOG_HEADER = struct.Struct("<4sII")
+# A length field above this can only come from a damaged header.
+MAX_LOG_RECORD_BYTES = 64 * 1024 * 1024
+# One JSON object per line, written by older versions.
+JSONL_LOG_PATH = DATA_DIR / "conversations.jsonl"
+# Three lines: last ingested record number, byte offset just past it, and
+# the name of the log file they refer to.
+STATE_PATH = DATA_DIR / "conversations_ingest_state.txt"
+# JSON state written by older versions; read once if STATE_PATH is missing.
+LEGACY_STATE_PATH = DATA_DIR / "conversations_ingest_state.json"
+EMBED_CACHE_PATH = DATA_DIR / "embedding_cache.sqlite3"
+
+EMBED_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+# GPU batch size model.encode() uses internally, and how many rows are
+# encoded and then written per collection.add() call.
+ENCODE_BATCH_SIZE = 128
+ADD_BATCH_SIZE = 5000
+# Stay under SQLite's bound-parameter limit for `IN (...)` lookups.
+CACHE_LOOKUP_CHUNK = 900
 
 
 def load_config() -> dict:
-    with CONFIG_PATH.open("r", encoding="utf-8") as f:
-        return yaml.safe_load(f)
+    return load_yaml(CONFIG_PATH)
 
 
-def load_state() -> int:
+def load_state() -> tuple[Path, int, int]:
     """
-    Return last ingested line number (1-based).
-    If no state file, assume nothing ingested yet (0).
+    Return (log path, last ingested record number (1-based), byte offset
+    just past it). If no state file, assume nothing ingested yet.
+
+    State written before the msgpack log existed refers to the JSONL log.
     """
-    if not STATE_PATH.exists():
-        return 0
     try:
-        data = json.loads(STATE_PATH.read_text(encoding="utf-8"))
-        return int(data.get("last_line", 0))
+        if STATE_PATH.exists():
+            parts = STATE_PATH.read_text(encoding="utf-8").split()
+            log_path = DATA_DIR / parts[2] if len(parts) > 2 else JSONL_LOG_PATH
+            return log_path, int(parts[0]), int(parts[1])
+        if LEGACY_STATE_PATH.exists():
+            data = orjson.loads(LEGACY_STATE_PATH.read_bytes())
+            return JSONL_LOG_PATH, int(data.get("last_line", 0)), int(data.get("offset", 0))
     except Exception:
-        return 0
+        pass
+    if JSONL_LOG_PATH.exists():
+        return JSONL_LOG_PATH, 0, 0
+    return LOG_PATH, 0, 0
 
 
-def save_state(last_line: int) -> None:
-    STATE_PATH.write_text(
-        json.dumps({"last_line": last_line}, ensure_ascii=False, indent=2),
-        encoding="utf-8",
-    )
+def save_state(log_path: Path, last_line: int, offset: int) -> None:
+    # Write then rename so a crash can't leave a half-written state file.
+    tmp_path = STATE_PATH.with_suffix(".tmp")
+    tmp_path.write_text(f"{last_line}\n{offset}\n{log_path.name}\n", encoding="utf-8")
+    os.replace(tmp_path, STATE_PATH)
 
 
-def iter_new_records(last_line: int):
+def iter_new_records(log_path: Path, last_line: int, offset: int):
     """
-    Yield (line_no, record_dict) for new lines after last_line.
+    Yield (record_no, end_offset, record_dict) for new records after last_line.
+
+    Reading starts at byte `offset` instead of re-scanning the whole log.
+    end_offset is the position just past the record, for save_state().
+    Blank or unparseable records are yielded with record_dict=None so the
+    caller can still advance past them. A trailing record that is not
+    complete yet is treated as still being written and left for the next run.
     """
-    if not LOG_PATH.exists():
-        print(f"[INFO] No conversation log found at {LOG_PATH}")
+    if not log_path.exists():
+        print(f"[INFO] No conversation log found at {log_path}")
         return
 
-    with LOG_PATH.open("r", encoding="utf-8") as f:
-        for i, line in enumerate(f, start=1):
-            if i <= last_line:
-                continue
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                rec = json.loads(line)
-            except Exception as e:
-                print(f"[WARN] Failed to parse JSON on line {i}: {e}")
+    with log_path.open("rb") as f:
+        if offset > log_path.stat().st_size:
+            print("[WARN] Conversation log is shorter than the saved offset; re-reading from the start.")
+            last_line, offset = 0, 0
+
+        if log_path.suffix == ".jsonl":
+            yield from _iter_jsonl_records(f, last_line, offset)
+        else:
+            yield from _iter_msgpack_records(f, last_line, offset)
+
+
+def _next_marker(f, start: int):
+    """Return the offset of the next LOG_MAGIC at or after start, or None."""
+    f.seek(start)
+    pos = start
+    carry = b""
+    while True:
+        block = f.read(1024 * 1024)
+        if not block:
+            return None
+        buf = carry + block
+        idx = buf.find(LOG_MAGIC)
+        if idx >= 0:
+            return pos - len(carry) + idx
+        carry = buf[-(len(LOG_MAGIC) - 1):]
+        pos += len(block)
+
+
+def _iter_msgpack_records(f, last_record: int, offset: int):
+    """
+    A header or body cut short by EOF is a record still being written and
+    is left for the next run. A record with a bad marker, an implausible
+    length or a CRC mismatch is reported and skipped up to the next marker,
+    yielded as None so the saved offset moves past it.
+    """
+    i = last_record
+    pos = offset
+    f.seek(pos)
+    while True:
+        header = f.read(LOG_HEADER.size)
+        if len(header) < LOG_HEADER.size:
+            break
+        magic, size, crc = LOG_HEADER.unpack(header)
+        if magic == LOG_MAGIC and size <= MAX_LOG_RECORD_BYTES:
+            body = f.read(size)
+            if len(body) < size:
+                break
+            if zlib.crc32(body) == crc:
+                i += 1
+                try:
+                    rec = msgpack.unpackb(body, raw=False)
+                except Exception as e:
+                    print(f"[WARN] Failed to parse record {i}: {e}")
+                    rec = None
+                pos = f.tell()
+                yield i, pos, rec
                 continue
-            yield i, rec
+
+        next_pos = _next_marker(f, pos + 1)
+        if next_pos is None:
+            print(f"[WARN] Damaged conversation log record at byte {pos}; no later record to resume from yet.")
+            break
+        print(f"[WARN] Skipping {next_pos - pos} damaged bytes at byte {pos} of the conversation log.")
+        i += 1
+        pos = next_pos
+        f.seek(pos)
+        yield i, pos, None
+
+
+def _iter_jsonl_records(f, last_line: int, offset: int):
+    i = 0
+    if offset:
+        f.seek(offset)
+        i = last_line
+    elif last_line:
+        # Old state file without an offset: skip the ingested prefix once.
+        for i, _ in zip(range(1, last_line + 1), f):
+            pass
+
+    for line in iter(f.readline, b""):
+        if not line.endswith(b"\n"):
+            break
+        i += 1
+        end_offset = f.tell()
+        line = line.strip()
+        if not line:
+            yield i, end_offset, None
+            continue
+        try:
+            rec = orjson.loads(line)
+        except Exception as e:
+            print(f"[WARN] Failed to parse JSON on line {i}: {e}")
+            yield i, end_offset, None
+            continue
+        yield i, end_offset, rec
+
+
+def iter_pending_records(log_path: Path, last_line: int, offset: int):
+    """
+    Yield ((log_path, record_no, end_offset), record_dict) for everything
+    not ingested yet. An older JSONL log is read to the end first, then
+    ingestion continues from the start of the msgpack log.
+    """
+    for record_no, end_offset, rec in iter_new_records(log_path, last_line, offset):
+        yield (log_path, record_no, end_offset), rec
+    if log_path != LOG_PATH and LOG_PATH.exists():
+        for record_no, end_offset, rec in iter_new_records(LOG_PATH, 0, 0):
+            yield (LOG_PATH, record_no, end_offset), rec
+
+
+def encode_docs(model: SentenceTransformer, docs):
+    """
+    Encode docs in one call into a numpy array of embeddings.
+
+    Docs are encoded shortest-first so each GPU batch pads to a similar
+    length, then the rows are put back in the original doc order.
+    """
+    lengths = np.fromiter((len(d) for d in docs), dtype=np.int64, count=len(docs))
+    order = np.argsort(lengths, kind="stable")
+    sorted_embeddings = model.encode(
+        [docs[i] for i in order],
+        batch_size=ENCODE_BATCH_SIZE,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+        show_progress_bar=True,
+    )
+    embeddings = np.empty_like(sorted_embeddings)
+    embeddings[order] = sorted_embeddings
+    return embeddings
+
+
+def embedding_model_key(cfg: dict) -> str:
+    """Name of the model as loaded, so ONNX and PyTorch vectors are cached apart."""
+    rag_cfg = cfg.get("rag", {})
+    if rag_cfg.get("embedding_backend") == "onnx":
+        return f"{EMBED_MODEL_NAME}:onnx:{rag_cfg.get('onnx_model_file', DEFAULT_ONNX_FILE)}"
+    return EMBED_MODEL_NAME
+
+
+def doc_hash(text: str, model_key: str = EMBED_MODEL_NAME) -> str:
+    """Cache key for a doc's embedding; includes the model so a swap invalidates it."""
+    return hashlib.blake2b(
+        f"{model_key}\0{text}".encode("utf-8"), digest_size=16
+    ).hexdigest()
+
+
+def open_embedding_cache() -> sqlite3.Connection:
+    DATA_DIR.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(EMBED_CACHE_PATH)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS embeddings (hash TEXT PRIMARY KEY, vec BLOB NOT NULL)"
+    )
+    return conn
+
+
+def encode_docs_cached(
+    model: SentenceTransformer, cache: sqlite3.Connection, docs, model_key: str = EMBED_MODEL_NAME
+):
+    """
+    Like encode_docs(), but reuse vectors for docs whose text was embedded
+    before. Only cache misses go through the model; their vectors are then
+    stored for the next run.
+
+    Returns a float16 array: MiniLM retrieval quality is unaffected and it
+    halves the memory held until the Chroma add.
+    """
+    hashes = [doc_hash(d, model_key) for d in docs]
+    cached = {}
+    for start in range(0, len(hashes), CACHE_LOOKUP_CHUNK):
+        chunk = hashes[start:start + CACHE_LOOKUP_CHUNK]
+        placeholders = ",".join("?" * len(chunk))
+        cached.update(
+            cache.execute(f"SELECT hash, vec FROM embeddings WHERE hash IN ({placeholders})", chunk)
+        )
+
+    embeddings = np.empty((len(docs), model.get_sentence_embedding_dimension()), dtype=np.float16)
+    misses = []
+    for i, h in enumerate(hashes):
+        vec = cached.get(h)
+        if vec is None:
+            misses.append(i)
+        else:
+            embeddings[i] = np.frombuffer(vec, dtype=np.float16)
+    print(f"[INFO] Embedding cache: {len(docs) - len(misses)} hits, {len(misses)} to encode.")
+
+    if misses:
+        new = encode_docs(model, [docs[i] for i in misses]).astype(np.float16)
+        embeddings[misses] = new
+        with cache:
+            cache.executemany(
+                "INSERT OR REPLACE INTO embeddings (hash, vec) VALUES (?, ?)",
+                (
+                    (hashes[i], new[j].tobytes())
+                    for j, i in enumerate(misses)
+                ),
+            )
+    return embeddings
 
 
 def main():
@@ -78,84 +308,105 @@ def main():
 
     index_dir.mkdir(parents=True, exist_ok=True)
 
-    client = chromadb.PersistentClient(
-        path=str(index_dir),
-        settings=Settings(allow_reset=False),
-    )
+    use_faiss = cfg["rag"].get("vector_store") == "faiss"
+    if use_faiss:
+        from vector_store import FaissStore
 
-    collection = client.get_or_create_collection(name=collection_name)
+        collection = FaissStore(index_dir, collection_name)
+    else:
+        client = chromadb.PersistentClient(
+            path=str(index_dir),
+            settings=Settings(allow_reset=False),
+        )
+        collection = open_chroma_collection(client, collection_name)
 
-    last_line = load_state()
-    print(f"[INFO] Last ingested line: {last_line}")
+    try:
+        log_path, last_line, offset = load_state()
+        print(f"[INFO] Last ingested record in {log_path.name}: {last_line} (byte offset {offset})")
 
-    # Embedding model (same as rag_index.py)
-    print("[INFO] Loading embedding model…")
-    model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+        # Same embedder (and rag.embedding_backend) as rag_index.py; when run
+        # from the router this reuses the model already loaded for queries.
+        model = get_embedder(cfg)
+        model_key = embedding_model_key(cfg)
 
-    docs = []
-    metadatas = []
-    ids = []
-    new_last_line = last_line
+        docs = []
+        metadatas = []
+        ids = []
+        new_state = (log_path, last_line, offset)
 
-    for line_no, rec in iter_new_records(last_line):
-        new_last_line = max(new_last_line, line_no)
+        for new_state, rec in iter_pending_records(log_path, last_line, offset):
+            if rec is None:
+                continue
 
-        user_prompt = rec.get("user_prompt", "").strip()
-        assistant_reply = rec.get("assistant_reply", "").strip()
-        timestamp = rec.get("timestamp", "")
-        model_name = rec.get("model", "")
-        used_rag = bool(rec.get("used_rag", False))
+            user_prompt = rec.get("user_prompt", "").strip()
+            assistant_reply = rec.get("assistant_reply", "").strip()
+            timestamp = rec.get("timestamp", "")
+            model_name = rec.get("model", "")
+            used_rag = bool(rec.get("used_rag", False))
 
-        if not user_prompt and not assistant_reply:
-            continue
+            if not user_prompt and not assistant_reply:
+                continue
 
-        # Compose a document text from user + assistant
-        text = (
-            f"[{timestamp}] (cli, model={model_name}, used_rag={used_rag})\n"
-            f"User:\n{user_prompt}\n\n"
-            f"Assistant:\n{assistant_reply}\n"
-        ).strip()
-
-        docs.append(text)
-        metadatas.append(
-            {
-                "source": "live_cli",
-                "timestamp": timestamp,
-                "model": model_name,
-                "used_rag": used_rag,
-            }
-        )
-        ids.append(f"live-cli-{line_no}")
-
-        # Batch insert every 64 docs
-        if len(docs) >= 64:
-            embeddings = model.encode(docs, show_progress_bar=False).tolist()
-            collection.add(
-                documents=docs,
-                embeddings=embeddings,
-                metadatas=metadatas,
-                ids=ids,
+            # Compose a document text from user + assistant
+            text = (
+                f"[{timestamp}] (cli, model={model_name}, used_rag={used_rag})\n"
+                f"User:\n{user_prompt}\n\n"
+                f"Assistant:\n{assistant_reply}\n"
+            ).strip()
+
+            docs.append(text)
+            metadatas.append(
+                {
+                    "source": "live_cli",
+                    "timestamp": timestamp,
+                    "model": model_name,
+                    "used_rag": used_rag,
+                }
             )
-            print(f"[INFO] Ingested {len(docs)} new conversation chunks (up to line {line_no}).")
-            docs, metadatas, ids = [], [], []
-
-    # Final flush
-    if docs:
-        embeddings = model.encode(docs, show_progress_bar=False).tolist()
-        collection.add(
-            documents=docs,
-            embeddings=embeddings,
-            metadatas=metadatas,
-            ids=ids,
-        )
-        print(f"[INFO] Ingested {len(docs)} new conversation chunks (final batch).")
-
-    # Update ingest state
-    if new_last_line > last_line:
-        save_state(new_last_line)
-        print(f"[INFO] Updated ingest state: last_line={new_last_line}")
-    else:
-        print("[INFO] No new conversations to ingest.")
+            source_path, record_no, _ = new_state
+            # JSONL ids are kept as-is so records ingested before stay unique.
+            prefix = "live-cli" if source_path.suffix == ".jsonl" else "live-cli-mpk"
+            ids.append(f"{prefix}-{record_no}")
+
+        if docs:
+            print(f"[INFO] Encoding {len(docs)} new conversations…")
+            # Encode slice N+1 while slice N is being written to Chroma. An add()
+            # failure is re-raised here, before the ingest state is advanced.
+            cache = open_embedding_cache()
+            pending = None
+            try:
+                with ThreadPoolExecutor(max_workers=1) as adder:
+                    for start in range(0, len(docs), ADD_BATCH_SIZE):
+                        end = start + ADD_BATCH_SIZE
+                        embeddings = encode_docs_cached(model, cache, docs[start:end], model_key)
+                        if pending is not None:
+                            pending.result()
+                        pending = adder.submit(
+                            collection.add,
+                            documents=docs[start:end],
+                            embeddings=embeddings,
+                            metadatas=metadatas[start:end],
+                            ids=ids[start:end],
+                        )
+                    pending.result()
+                if use_faiss:
+                    collection.save()
+            finally:
+                cache.close()
+            print(f"[INFO] Ingested {len(docs)} new conversation chunks (up to record {new_state[1]} of {new_state[0].name}).")
+
+        # Update ingest state
+        if new_state != (log_path, last_line, offset):
+            save_state(*new_state)
+            print(
+                f"[INFO] Updated ingest state: log={new_state[0].name}, "
+                f"last_line={new_state[1]}, offset={new_state[2]}"
+            )
+        else:
+            print("[INFO] No new conversations to ingest.")
+    finally:
+        if use_faiss:
+            collection.close()
 
 
 if __name__ == "__main__":
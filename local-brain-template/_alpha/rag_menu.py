@@ -9,6 +9,7 @@ Provides:
 - A 'help screen' showing all relevant commands and what they do
 """
 
+import os
 import sys
 import subprocess
 import textwrap
@@ -26,8 +27,13 @@ def run_subprocess(cmd, cwd=None):
 
 
 def clear_screen():
-    # Cross-platform-ish clear
-    subprocess.run(["clear"], check=False)
+    # Legacy Windows consoles may not understand ANSI escapes; shell out there.
+    if os.name == "nt":
+        subprocess.run("cls", shell=True, check=False)
+        return
+    # Erase screen + move cursor home, without spawning `clear`.
+    sys.stdout.write("\x1b[2J\x1b[H")
+    sys.stdout.flush()
 
 
 def print_header():
@@ -83,7 +89,7 @@ def print_help_reference():
         ),
         (
             "python ingest_conversations.py",
-            "Ingest new CLI conversations from data/conversations.jsonl into the RAG index."
+            "Ingest new CLI conversations from data/conversations.mpk into the RAG index."
         ),
 
     ]
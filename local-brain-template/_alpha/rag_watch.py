@@ -1,31 +1,78 @@
 #!/usr/bin/env python3
 import time
 import pathlib
+import threading
 from typing import Any, Dict
 
-import yaml
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
+from brain_settings import load_yaml
 # For simplicity we just call the full build_index() for now
 from rag_index import build_index, CONFIG_PATH
 
 
+# Seconds of quiet after the last event before the index is rebuilt.
+DEBOUNCE_SECONDS = 5.0
+# Only changes to these files can affect the export contents.
+WATCHED_SUFFIXES = (".json", ".zip")
+
+
 class ExportChangeHandler(FileSystemEventHandler):
-    def __init__(self, export_dir: pathlib.Path):
+    def __init__(self, export_dir: pathlib.Path, debounce: float = DEBOUNCE_SECONDS):
         super().__init__()
         self.export_dir = export_dir
+        self.debounce = debounce
+        self._timer: threading.Timer | None = None
+        self._timer_lock = threading.Lock()
+        # Held for the duration of a rebuild so two can never overlap.
+        self._build_lock = threading.Lock()
+        # Start time of the last successful rebuild.
+        self._last_build = 0.0
+
+    def on_created(self, event):
+        self._handle(event)
+
+    def on_modified(self, event):
+        self._handle(event)
 
-    def on_any_event(self, event):
-        # Debounce could be added, but for now we just rebuild fully.
+    def _handle(self, event):
+        if event.is_directory or not str(event.src_path).endswith(WATCHED_SUFFIXES):
+            return
         print(f"[EVENT] Change detected: {event.src_path}")
-        print("[INFO] Rebuilding index due to change…")
-        build_index()
+        self.schedule_rebuild()
+
+    def schedule_rebuild(self):
+        """(Re)start the quiet-period timer; a burst of events yields one rebuild."""
+        with self._timer_lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.debounce, self._rebuild, args=(time.time(),))
+            self._timer.daemon = True
+            self._timer.start()
+
+    def cancel(self):
+        with self._timer_lock:
+            if self._timer is not None:
+                self._timer.cancel()
+
+    def _rebuild(self, requested_at: float):
+        with self._build_lock:
+            if requested_at < self._last_build:
+                # A rebuild that started after this event already covered it.
+                return
+            started = time.time()
+            print("[INFO] Rebuilding index due to change…")
+            try:
+                build_index()
+            except Exception as e:
+                print(f"[ERROR] Index rebuild failed: {e!r}")
+                return
+            self._last_build = started
 
 
 def load_config() -> Dict[str, Any]:
-    with open(CONFIG_PATH, "r") as f:
-        return yaml.safe_load(f)
+    return load_yaml(CONFIG_PATH)
 
 
 def main():
@@ -43,6 +90,7 @@ def main():
             time.sleep(1)
     except KeyboardInterrupt:
         print("[INFO] Stopping watcher…")
+        event_handler.cancel()
         observer.stop()
     observer.join()
 
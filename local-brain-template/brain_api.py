@@ -12,7 +12,7 @@ v1 "brain service" for your local setup.
     - POST /chat     (simple CLI/testing endpoint)
 
 - Uses your existing RAG index (Chroma) + LM Studio backend
-- Logs all interactions to data/conversations.jsonl
+- Logs all interactions to data/conversations.mpk
 
 Frontends (Open WebUI, CLI, n8n, etc.) should talk to THIS,
 not directly to LM Studio.
@@ -24,7 +24,9 @@ from datetime import datetime, timezone
 from pathlib import Path
 from typing import List, Optional
 
-import json
+import asyncio
+import queue
+import threading
 import time
 
 from fastapi import FastAPI, HTTPException
@@ -33,9 +35,10 @@ from pydantic import BaseModel, Field
 # Reuse your existing helpers from llm_rag_cli.py
 from llm_rag_cli import (
     load_config,
-    get_collection,
-    retrieve_context,
+    get_cached_collection,
+    build_rag_message,
     call_lm_studio,
+    append_log_records,
 )
 
 # -------------------------------------------------------------------
@@ -44,7 +47,7 @@ from llm_rag_cli import (
 
 HERE = Path(__file__).resolve().parent
 DATA_DIR = HERE / "data"
-LOG_PATH = DATA_DIR / "conversations.jsonl"
+LOG_PATH = DATA_DIR / "conversations.mpk"
 
 app = FastAPI(
     title="Local Brain API",
@@ -52,6 +55,15 @@ app = FastAPI(
     description="RAG + LM Studio backed personal brain.",
 )
 
+@app.on_event("startup")
+def open_collection() -> None:
+    # Open the shared Chroma collection once, before the first request.
+    try:
+        get_cached_collection(load_config())
+    except Exception as e:
+        # Requests will retry opening it themselves.
+        print(f"[WARN] Failed to open Chroma collection at startup: {e}", flush=True)
+
 # -------------------------------------------------------------------
 # Pydantic models for OpenAI-style API
 # -------------------------------------------------------------------
@@ -82,6 +94,52 @@ class SimpleChatRequest(BaseModel):
 # Logging
 # -------------------------------------------------------------------
 
+# Records are handed to a single writer thread so the chat endpoint never
+# waits on disk. If the writer falls this far behind, new records are dropped.
+_LOG_QUEUE_SIZE = 1000
+_LOG_QUEUE: queue.Queue = queue.Queue(maxsize=_LOG_QUEUE_SIZE)
+_LOG_THREAD: Optional[threading.Thread] = None
+
+
+def _write_log_records(records: List[dict]) -> None:
+    try:
+        append_log_records(LOG_PATH, records)
+    except Exception as e:
+        # Logging must NEVER break the main flow
+        print(f"[WARN] Failed to log interaction: {e}", flush=True)
+
+
+def _log_writer() -> None:
+    """Drain _LOG_QUEUE, appending whatever is queued in one write. None stops it."""
+    while True:
+        records = [_LOG_QUEUE.get()]
+        while True:
+            try:
+                records.append(_LOG_QUEUE.get_nowait())
+            except queue.Empty:
+                break
+        stop = None in records
+        records = [r for r in records if r is not None]
+        if records:
+            _write_log_records(records)
+        if stop:
+            return
+
+
+@app.on_event("startup")
+def start_log_writer() -> None:
+    global _LOG_THREAD
+    _LOG_THREAD = threading.Thread(target=_log_writer, name="log-writer", daemon=True)
+    _LOG_THREAD.start()
+
+
+@app.on_event("shutdown")
+def stop_log_writer() -> None:
+    if _LOG_THREAD is not None:
+        _LOG_QUEUE.put(None)
+        _LOG_THREAD.join(timeout=5)
+
+
 def log_interaction(
     source: str,
     model_name: str,
@@ -92,31 +150,39 @@ def log_interaction(
     assistant_reply: str,
 ) -> None:
     """
-    Append a JSONL record to data/conversations.jsonl.
+    Queue a record for data/conversations.mpk.
     This will be the canonical log for later ingestion.
     """
+    record = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "source": source,  # e.g. "web", "cli", "openwebui"
+        "model": model_name,
+        "used_rag": used_rag,
+        "user_prompt": user_prompt,
+        "sent_prompt": sent_prompt,
+        "rag_context": rag_context,
+        "assistant_reply": assistant_reply,
+    }
+    if _LOG_THREAD is None:
+        # App startup hasn't run (e.g. run_rag_completion called directly).
+        _write_log_records([record])
+        return
     try:
-        DATA_DIR.mkdir(parents=True, exist_ok=True)
-        record = {
-            "timestamp": datetime.now(timezone.utc).isoformat(),
-            "source": source,  # e.g. "web", "cli", "openwebui"
-            "model": model_name,
-            "used_rag": used_rag,
-            "user_prompt": user_prompt,
-            "sent_prompt": sent_prompt,
-            "rag_context": rag_context,
-            "assistant_reply": assistant_reply,
-        }
-        with LOG_PATH.open("a", encoding="utf-8") as f:
-            f.write(json.dumps(record, ensure_ascii=False) + "\n")
-    except Exception as e:
-        # Logging must NEVER break the main flow
-        print(f"[WARN] Failed to log interaction: {e}", flush=True)
+        _LOG_QUEUE.put_nowait(record)
+    except queue.Full:
+        print("[WARN] Log queue full; dropping interaction record.", flush=True)
 
 # -------------------------------------------------------------------
 # Core RAG + LM Studio logic
 # -------------------------------------------------------------------
 
+_BASE_SYSTEM_PROMPT = (
+    "You are my local AI assistant, backed by a personal memory index (RAG).\n"
+    "Use retrieved context when it clearly helps; otherwise answer normally.\n"
+    "Be concise, technically accurate, and directly actionable.\n"
+)
+_SYSTEM_EXTRA_PREFIX = "\n\nAdditional UI/system instructions:\n"
+
 def run_rag_completion(
     req: OpenAIChatCompletionRequest,
     source: str = "web",
@@ -145,33 +211,13 @@ def run_rag_completion(
         raise HTTPException(status_code=400, detail="No user content found in messages")
 
     # RAG retrieval
-    used_rag_flag = False
-    rag_context_text = ""
-    final_user_message = user_prompt
-
-    collection = get_collection(cfg)
-    if collection is not None:
-        context = retrieve_context(collection, user_prompt, cfg)
-        if context:
-            used_rag_flag = True
-            rag_context_text = context
-            final_user_message = (
-                "Use the following retrieved context to answer the question if it is relevant.\n"
-                "If it is not relevant, ignore it and answer normally.\n\n"
-                "### Retrieved context\n"
-                f"{context}\n\n"
-                "### Question\n"
-                f"{user_prompt}"
-            )
+    final_user_message, rag_context_text, used_rag_flag = build_rag_message(user_prompt, cfg)
 
     # System prompt
-    base_system_prompt = (
-        "You are my local AI assistant, backed by a personal memory index (RAG).\n"
-        "Use retrieved context when it clearly helps; otherwise answer normally.\n"
-        "Be concise, technically accurate, and directly actionable.\n"
-    )
     if system_extra:
-        base_system_prompt += "\n\nAdditional UI/system instructions:\n" + system_extra
+        system_prompt = _BASE_SYSTEM_PROMPT + _SYSTEM_EXTRA_PREFIX + system_extra
+    else:
+        system_prompt = _BASE_SYSTEM_PROMPT
 
     # ----------------------------------------------------------------
     # Call LM Studio
@@ -180,7 +226,7 @@ def run_rag_completion(
     answer = call_lm_studio(
         cfg,
         final_user_message,
-        system_prompt=base_system_prompt,
+        system_prompt=system_prompt,
         model=model_name,
     )
 
@@ -223,7 +269,7 @@ def run_rag_completion(
 # -------------------------------------------------------------------
 
 @app.get("/health")
-def health():
+async def health():
     """
     Basic health check:
     - Can we load config?
@@ -269,18 +315,20 @@ def list_models():
 
 
 @app.post("/v1/chat/completions")
-def chat_completions(req: OpenAIChatCompletionRequest):
+async def chat_completions(req: OpenAIChatCompletionRequest):
     """
     OpenAI-compatible chat completions endpoint.
 
     This is what Open WebUI (and any other OpenAI client) should call.
+    Retrieval + the LM Studio call block, so they run in a worker thread
+    and the event loop stays free for other in-flight completions.
     """
-    return run_rag_completion(req, source="web")
+    return await asyncio.to_thread(run_rag_completion, req, "web")
 
 # -------- Simple /chat for CLI/testing --------
 
 @app.post("/chat")
-def chat_simple(req: SimpleChatRequest):
+async def chat_simple(req: SimpleChatRequest):
     """
     Simpler /chat endpoint for CLI, scripts, etc.
     """
@@ -290,5 +338,5 @@ def chat_simple(req: SimpleChatRequest):
         temperature=req.temperature,
         max_tokens=req.max_tokens,
     )
-    resp = run_rag_completion(oai_req, source="cli")
+    resp = await asyncio.to_thread(run_rag_completion, oai_req, "cli")
     return {"reply": resp["choices"][0]["message"]["content"], "raw": resp}
@@ -10,11 +10,98 @@ All other scripts should import from here instead of hardcoding paths.
 from __future__ import annotations
 
 from pathlib import Path
+import functools
+import os
+import pickle
+import tempfile
 import yaml
 
 ROOT = Path(__file__).resolve().parent
 CONFIG_PATH = ROOT / "config.yaml"
 
+# HNSW settings for new Chroma collections. Embeddings are L2-normalized on
+# both the index and query side, so cosine space matches them directly.
+# They are only passed when a collection is created (see
+# open_chroma_collection); rebuild the index (delete the index dir, rerun
+# rag_index.py) to move an existing one over.
+HNSW_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 24,
+    "hnsw:construction_ef": 200,
+    "hnsw:search_ef": 64,
+}
+
+# libyaml's C loader if PyYAML was built with it, else the pure-Python one.
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+YAML_DUMPER = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+
+@functools.lru_cache(maxsize=8)
+def _parse_yaml(path: str, mtime_ns: int, size: int):
+    # A pickled copy next to the YAML file (config.pkl for config.yaml) is
+    # much faster to load on a fresh process. It stores the (mtime_ns, size)
+    # of the YAML it came from and is only used on an exact match, so a
+    # config restored with an older mtime is still picked up.
+    pkl_path = Path(path).with_suffix(".pkl")
+    try:
+        with open(pkl_path, "rb") as f:
+            stamp, data = pickle.load(f)
+        if stamp == (mtime_ns, size):
+            return data
+    except (OSError, pickle.UnpicklingError, EOFError, TypeError, ValueError):
+        pass
+
+    with open(path, "r", encoding="utf-8") as f:
+        data = yaml.load(f, Loader=YAML_LOADER)
+
+    tmp_name = None
+    try:
+        # Unique temp name: several processes (e.g. server workers) may
+        # rewrite the pickle at the same time.
+        with tempfile.NamedTemporaryFile(
+            dir=pkl_path.parent, prefix=pkl_path.name + ".", suffix=".tmp", delete=False
+        ) as f:
+            tmp_name = f.name
+            pickle.dump(((mtime_ns, size), data), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_name, pkl_path)
+    except OSError:
+        # Read-only checkout etc.; just parse the YAML next time.
+        if tmp_name is not None:
+            try:
+                os.unlink(tmp_name)
+            except OSError:
+                pass
+    return data
+
+
+def open_chroma_collection(client, name: str):
+    """
+    Open a Chroma collection, creating it with HNSW_METADATA if it is missing.
+
+    The metadata is only passed on creation: on chromadb 0.4/0.5,
+    get_or_create_collection(metadata=...) overwrites an existing
+    collection's stored metadata while its HNSW segment keeps the space it
+    was built with, so an old l2 collection would claim to be cosine.
+    """
+    try:
+        return client.get_collection(name=name)
+    except Exception:  # not found; the exception type varies by chromadb version
+        pass
+    try:
+        return client.create_collection(name=name, metadata=HNSW_METADATA)
+    except Exception:  # another process created it in the meantime
+        return client.get_collection(name=name)
+
+
+def load_yaml(path: Path):
+    """
+    Parse a YAML file, re-reading it only when its mtime or size changes.
+
+    The result is shared between callers, so treat it as read-only.
+    """
+    st = path.stat()
+    return _parse_yaml(str(path), st.st_mtime_ns, st.st_size)
+
 
 class BrainConfig:
     def __init__(self, data: dict):
@@ -60,9 +147,14 @@ class BrainConfig:
         return int(self._data.get("api", {}).get("port", 8001))
 
 
+@functools.lru_cache(maxsize=1)
+def _load_brain_config(mtime_ns: int, size: int) -> BrainConfig:
+    return BrainConfig(_parse_yaml(str(CONFIG_PATH), mtime_ns, size) or {})
+
+
 def load_brain_config() -> BrainConfig:
+    """Return the BrainConfig, re-parsing config.yaml only when it changes."""
     if not CONFIG_PATH.exists():
         raise RuntimeError(f"Config file not found: {CONFIG_PATH}")
-    with CONFIG_PATH.open("r", encoding="utf-8") as f:
-        data = yaml.safe_load(f) or {}
-    return BrainConfig(data)
+    st = CONFIG_PATH.stat()
+    return _load_brain_config(st.st_mtime_ns, st.st_size)
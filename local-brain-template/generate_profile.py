@@ -6,12 +6,12 @@ Generate a profile.md summarizing who I am, what I work on, and my preferences,
 based on my RAG index + LM Studio.
 """
 
-from copy import deepcopy
 import pathlib
 import textwrap
 
 from llm_rag_cli import (
     load_config,
+    with_rag_overrides,
     get_collection,
     retrieve_context,
     call_lm_studio,
@@ -24,10 +24,8 @@ PROFILE_PATH = HERE / "profile.md"
 
 def main():
     cfg = load_config()
-    cfg_big = deepcopy(cfg)
-    cfg_big.setdefault("rag", {})
-    cfg_big["rag"]["max_context_chars"] = int(
-        cfg_big["rag"].get("max_context_chars", 8000) * 2
+    cfg_big = with_rag_overrides(
+        cfg, max_context_chars=int(cfg.get("rag", {}).get("max_context_chars", 8000) * 2)
     )
 
     collection = get_collection(cfg_big)
@@ -1,70 +1,296 @@
 #!/usr/bin/env python3
 import argparse
+import functools
+import io
 import pathlib
+import struct
 import sys
-import textwrap
-import json
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 
-import yaml
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+import msgpack
+import orjson
 import chromadb
 from chromadb.config import Settings
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from brain_settings import load_yaml, open_chroma_collection
 
 
 HERE = pathlib.Path(__file__).resolve().parent
 CONFIG_PATH = HERE / "config.yaml"
 DATA_DIR = HERE / "data"
-LOG_PATH = DATA_DIR / "conversations.jsonl"
+# Framed msgpack records; see encode_log_record().
+LOG_PATH = DATA_DIR / "conversations.mpk"
+# Each record starts with this marker, then uint32 body length and CRC32
+# (little-endian), so a reader can spot a damaged record and skip to the
+# next marker.
+LOG_MAGIC = b"LBR1"
+LOG_HEADER = struct.Struct("<4sII")
+
+# Shared across calls so LM Studio connections are kept alive and reused
+# instead of paying a TCP (and TLS, for remote servers) setup per request.
+# Only 502/503/504 responses (e.g. a model still loading) are retried, with
+# backoff; POSTs are included since LM Studio hasn't run the completion in
+# those cases. Connection, read and other errors are never retried: the
+# request may already be generating, and repeating it would start another.
+_RETRY = Retry(
+    total=3,
+    connect=0,
+    read=0,
+    other=0,
+    backoff_factor=2,
+    status_forcelist=[502, 503, 504],
+    allowed_methods=frozenset({"GET", "POST"}),
+    raise_on_status=False,
+)
+_SESSION = requests.Session()
+_SESSION.headers.update({"Content-Type": "application/json"})
+_SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=_RETRY))
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=_RETRY))
+
+# Open Chroma collections, keyed by (index_dir, collection_name).
+_COLLECTIONS: dict = {}
+_COLLECTIONS_LOCK = threading.Lock()
+
+SYSTEM_PROMPT_CLI = "\n\n".join([
+    "You are my local AI assistant. Your goal is to help me solve problems efficiently.",
+    "You have access to a retrieval index of my past ChatGPT conversations and personal technical notes.",
+    "Use retrieved context when it is clearly relevant and improves precision, otherwise rely on general reasoning.",
+    "Keep answers concise, technically accurate, and directly actionable.",
+    "If the query depends on missing details, ask for the minimal clarification needed.",
+    "Avoid hallucinating; if uncertain, state the uncertainty and suggest a safe next action.",
+])
+
+# Start of the block format_context() builds; pieces are separated by blank lines.
+CONTEXT_HEADER = (
+    "The following context is retrieved from my past ChatGPT conversations. "
+    "Use it to ground your answer, but do NOT repeat it verbatim unless necessary.\n\n"
+)
+CONTEXT_SEPARATOR = "\n\n"
+
+# final_user_message = RAG_PREFIX + context + RAG_MIDDLE + question
+RAG_PREFIX = (
+    "Use the following retrieved context to answer the question if it is relevant.\n"
+    "If it is not relevant, ignore it and answer normally.\n\n"
+    "### Retrieved context\n"
+)
+RAG_MIDDLE = "\n\n### Question\n"
 
 def load_config() -> dict:
-    with open(CONFIG_PATH, "r") as f:
-        return yaml.safe_load(f)
+    """
+    Return the parsed config.yaml.
+
+    The parse is cached and only redone when the file's mtime changes, so
+    per-request callers (brain_api, router) don't re-read YAML every time.
+    Callers must treat the returned dict as read-only.
+    """
+    return load_yaml(CONFIG_PATH)
+
+
+def with_rag_overrides(cfg: dict, **overrides) -> dict:
+    """
+    Return a copy of cfg with the given keys replaced in its "rag" section.
+
+    Only the top level and "rag" are copied, so the shared dict from
+    load_config() is left untouched.
+    """
+    return {**cfg, "rag": {**cfg.get("rag", {}), **overrides}}
 
 
 def get_collection(cfg: dict):
     index_dir = pathlib.Path(cfg["index_dir"]).expanduser()
     collection_name = cfg["rag"]["collection_name"]
+    if cfg["rag"].get("vector_store") == "faiss":
+        # Imported lazily so faiss is only needed when it is enabled.
+        from vector_store import FaissStore
+
+        return FaissStore(index_dir, collection_name, read_only=True)
     client = chromadb.PersistentClient(
         path=str(index_dir),
         settings=Settings(allow_reset=False),
     )
-    return client.get_or_create_collection(name=collection_name)
+    return open_chroma_collection(client, collection_name)
+
+
+def _collection_key(cfg: dict) -> tuple:
+    return (str(pathlib.Path(cfg["index_dir"]).expanduser()), cfg["rag"]["collection_name"])
+
+
+def get_cached_collection(cfg: dict):
+    """
+    Like get_collection(), but opens each index/collection only once per
+    process and hands the same handle to every later caller (e.g. each
+    request in a long-running API server).
+    """
+    key = _collection_key(cfg)
+    collection = _COLLECTIONS.get(key)
+    if collection is None:
+        with _COLLECTIONS_LOCK:
+            collection = _COLLECTIONS.get(key)
+            if collection is None:
+                collection = _COLLECTIONS[key] = get_collection(cfg)
+    return collection
 
 
 def retrieve_context(collection, query: str, cfg: dict) -> str:
     top_k = int(cfg["rag"].get("top_k", 8))
     max_chars = int(cfg["rag"].get("max_context_chars", 8000))
-
-    results = collection.query(
-        query_texts=[query],
-        n_results=top_k,
+    return _query_context(collection, (query,), top_k, max_chars)
+
+
+@functools.lru_cache(maxsize=128)
+def embed_query(query: str) -> tuple:
+    """
+    Embed a query with the same model rag_index uses for documents, instead
+    of letting Chroma run its own default embedding function per query.
+    Cached so UI retries of the same question don't re-run the model.
+    """
+    # Imported lazily: loading torch/sentence-transformers is only worth it
+    # once we actually need to retrieve.
+    from rag_index import get_embedder
+
+    vec = get_embedder(load_config()).encode(
+        [query], convert_to_numpy=True, normalize_embeddings=True
+    )[0]
+    return tuple(vec.tolist())
+
+
+def embed_queries(queries) -> list:
+    """
+    Embed several queries in a single encode() call, so the tokenizer and
+    model run once for the whole batch.
+    """
+    if len(queries) == 1:
+        return [list(embed_query(queries[0]))]
+
+    from rag_index import get_embedder
+
+    vecs = get_embedder(load_config()).encode(
+        list(queries), convert_to_numpy=True, normalize_embeddings=True
     )
+    return vecs.tolist()
 
-    docs = results.get("documents", [[]])[0]
-    metas = results.get("metadatas", [[]])[0]
 
-    context_chunks = []
+def format_context(docs, metas, max_chars: int) -> str:
+    """Render retrieved chunks as the RAG context block, up to max_chars."""
+    buf = io.StringIO()
     total_chars = 0
 
     for doc, meta in zip(docs, metas):
-        piece = f"[{meta.get('conversation_title', 'unknown')}] ({meta.get('role')}):\n{doc}\n"
+        # A piece is always longer than its doc, so this rules it out
+        # before building the string.
+        if total_chars + len(doc) > max_chars:
+            break
+        piece = "[%s] (%s):\n%s\n" % (meta.get("conversation_title", "unknown"), meta.get("role"), doc)
         if total_chars + len(piece) > max_chars:
             break
-        context_chunks.append(piece)
+        buf.write(CONTEXT_SEPARATOR if total_chars else CONTEXT_HEADER)
+        buf.write(piece)
         total_chars += len(piece)
 
-    if not context_chunks:
-        return ""
+    return buf.getvalue()
+
+
+def _query_context(collection, queries: tuple, top_k: int, max_chars: int) -> str:
+    """
+    Retrieve top_k chunks for each query with one collection.query() call.
+
+    With several queries the hit lists are interleaved by rank (every
+    query's best hit first) and de-duplicated by id, so a chunk matched by
+    more than one turn is only included once.
+    """
+    results = collection.query(
+        query_embeddings=embed_queries(queries),
+        n_results=top_k,
+    )
 
-    header = (
-        "The following context is retrieved from my past ChatGPT conversations. "
-        "Use it to ground your answer, but do NOT repeat it verbatim unless necessary.\n\n"
+    if len(queries) == 1:
+        docs = results.get("documents", [[]])[0]
+        metas = results.get("metadatas", [[]])[0]
+        return format_context(docs, metas, max_chars)
+
+    hits = list(zip(results["ids"], results["documents"], results["metadatas"]))
+    merged = {}
+    for rank in range(max(len(ids) for ids, _, _ in hits)):
+        for ids, docs, metas in hits:
+            if rank < len(ids):
+                merged.setdefault(ids[rank], (docs[rank], metas[rank]))
+
+    return format_context(
+        [doc for doc, _ in merged.values()],
+        [meta for _, meta in merged.values()],
+        max_chars,
     )
-    return header + "\n\n".join(context_chunks)
 
 
-def call_lm_studio(cfg: dict, user_message: str, system_prompt: str = "", model: str | None = None) -> str:
+def _index_version(cfg: dict) -> int:
+    """
+    Newest mtime of the files the vector store writes on every change, so it
+    moves whenever the index is rebuilt or ingested into, by any process.
+    """
+    index_dir = pathlib.Path(cfg["index_dir"]).expanduser()
+    if cfg["rag"].get("vector_store") == "faiss":
+        paths = [index_dir / f"{cfg['rag']['collection_name']}.faiss"]
+    else:
+        paths = [index_dir / "chroma.sqlite3", index_dir / "chroma.sqlite3-wal"]
+    version = 0
+    for path in paths:
+        try:
+            version = max(version, path.stat().st_mtime_ns)
+        except OSError:
+            pass
+    return version
+
+
+@functools.lru_cache(maxsize=256)
+def _cached_context(
+    collection_key: tuple, index_version: int, queries: tuple, top_k: int, max_chars: int
+) -> str:
+    # Only called after get_cached_collection() has opened collection_key.
+    # index_version is only part of the key: a newer index misses the cache.
+    return _query_context(_COLLECTIONS[collection_key], queries, top_k, max_chars)
+
+
+def clear_retrieval_cache() -> None:
+    """Forget cached retrievals, e.g. after new documents were ingested."""
+    _cached_context.cache_clear()
+
+
+def build_rag_message(user_prompt: str, cfg: dict, queries=None) -> tuple[str, str, bool]:
+    """
+    Retrieve context for user_prompt and wrap both into the message sent to
+    the model. Returns (final_user_message, rag_context, used_rag).
+
+    `queries` optionally retrieves with several texts (e.g. the last few
+    chat turns) in one batched lookup instead of with user_prompt itself.
+
+    Retrievals are cached per (collection, queries, top_k, max_chars), so a
+    repeated question (e.g. "regenerate" in a UI) skips the Chroma query.
+    The cache key includes the index files' mtime, so a rebuild or ingest
+    from another process (rag_index.py, rag_watch) is picked up right away.
+    """
+    top_k = int(cfg["rag"].get("top_k", 8))
+    max_chars = int(cfg["rag"].get("max_context_chars", 8000))
+    get_cached_collection(cfg)
+    queries = tuple(queries) if queries else (user_prompt,)
+    context = _cached_context(_collection_key(cfg), _index_version(cfg), queries, top_k, max_chars)
+    if not context:
+        return user_prompt, "", False
+    return "".join((RAG_PREFIX, context, RAG_MIDDLE, user_prompt)), context, True
+
+
+def _chat_request(cfg: dict, user_message: str, system_prompt: str, model: str | None, stream: bool):
+    """Build (url, payload, headers) for an LM Studio /chat/completions call."""
     lm_cfg = cfg["lm_studio"]
     base_url = lm_cfg["base_url"].rstrip("/")
     api_key = lm_cfg["api_key"]
@@ -82,15 +308,36 @@ def call_lm_studio(cfg: dict, user_message: str, system_prompt: str = "", model:
         "messages": messages,
         "temperature": 0.3,
         "max_tokens": 1024,
-        "stream": False,
+        "stream": stream,
     }
 
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-    }
+    headers = {"Authorization": f"Bearer {api_key}"}
+    return url, payload, headers
+
 
-    resp = requests.post(url, json=payload, headers=headers, timeout=300)
+def call_lm_studio(
+    cfg: dict,
+    user_message: str,
+    system_prompt: str = "",
+    model: str | None = None,
+    stream: bool = False,
+) -> str:
+    """
+    Return the model's reply. With stream=True the reply is also written to
+    stdout as it arrives, so long reports start showing right away.
+    """
+    if stream:
+        parts = []
+        for piece in call_lm_studio_stream(cfg, user_message, system_prompt, model=model):
+            sys.stdout.write(piece)
+            sys.stdout.flush()
+            parts.append(piece)
+        sys.stdout.write("\n")
+        return "".join(parts)
+
+    url, payload, headers = _chat_request(cfg, user_message, system_prompt, model, stream=False)
+
+    resp = _SESSION.post(url, json=payload, headers=headers, timeout=300)
     resp.raise_for_status()
     data = resp.json()
 
@@ -99,6 +346,166 @@ def call_lm_studio(cfg: dict, user_message: str, system_prompt: str = "", model:
     except Exception as e:
         return f"[ERROR] Unexpected response from LM Studio: {e}\nRaw: {data}"
 
+
+def call_lm_studio_stream(cfg: dict, user_message: str, system_prompt: str = "", model: str | None = None):
+    """
+    Streaming variant of call_lm_studio(): yields the reply text piece by
+    piece as LM Studio sends its SSE `data:` frames.
+    """
+    url, payload, headers = _chat_request(cfg, user_message, system_prompt, model, stream=True)
+
+    with _SESSION.post(url, json=payload, headers=headers, timeout=300, stream=True) as resp:
+        resp.raise_for_status()
+        for line in resp.iter_lines():
+            if not line.startswith(b"data:"):
+                continue
+            data = line[len(b"data:"):].strip()
+            if data == b"[DONE]":
+                break
+            try:
+                delta = orjson.loads(data)["choices"][0].get("delta", {}).get("content")
+            except Exception:
+                continue
+            if delta:
+                yield delta
+
+
+# Used when LM Studio doesn't report the loaded model's context length.
+DEFAULT_CONTEXT_TOKENS = 4096
+# Share of the model's context one map_reduce_report() slice may fill, and
+# the rough characters-per-token ratio used to turn that into characters.
+MAP_CONTEXT_FRACTION = 0.6
+CHARS_PER_TOKEN = 4
+MAP_WORKERS = 4
+
+
+def loaded_context_length(cfg: dict, model: str | None = None) -> int:
+    """
+    Context length (tokens) the model is loaded with in LM Studio, read from
+    its native /api/v0/models endpoint; DEFAULT_CONTEXT_TOKENS if unknown.
+    """
+    base_url = cfg["lm_studio"]["base_url"].rstrip("/")
+    root = base_url[:-len("/v1")] if base_url.endswith("/v1") else base_url
+    model = model or cfg["lm_studio"]["model"]
+    try:
+        resp = _SESSION.get(f"{root}/api/v0/models", timeout=1.5)
+        resp.raise_for_status()
+        for info in resp.json().get("data", []):
+            if info.get("id") == model:
+                length = info.get("loaded_context_length") or info.get("max_context_length")
+                if length:
+                    return int(length)
+    except (requests.RequestException, ValueError) as e:
+        print(f"[WARN] Could not read context length from LM Studio: {e}", file=sys.stderr)
+    return DEFAULT_CONTEXT_TOKENS
+
+
+def split_context(context: str, max_chars: int) -> list[str]:
+    """
+    Split context at paragraph boundaries into slices of at most max_chars
+    (a single longer paragraph is cut hard). The first slice gets half the
+    budget so the first map call returns sooner.
+    """
+    slices = []
+    current = []
+    current_len = 0
+    budget = max(1, max_chars // 2)
+    for para in context.split("\n\n"):
+        while len(para) > budget:
+            if current:
+                slices.append("\n\n".join(current))
+                current, current_len, budget = [], 0, max_chars
+            slices.append(para[:budget])
+            para = para[budget:]
+            budget = max_chars
+        if not para:
+            # Nothing left after a hard split (or an empty paragraph): don't
+            # start a slice that is empty or only a separator.
+            continue
+        if current and current_len + 2 + len(para) > budget:
+            slices.append("\n\n".join(current))
+            current, current_len, budget = [], 0, max_chars
+        current_len += len(para) + (2 if current else 0)
+        current.append(para)
+    if current:
+        slices.append("\n\n".join(current))
+    return slices
+
+
+def map_reduce_report(
+    cfg: dict,
+    context: str,
+    prompt_template: str,
+    map_instruction: str,
+    system_prompt: str = "",
+    stream: bool = False,
+) -> str:
+    """
+    Run prompt_template (with a {context} field) over context, which may be
+    too long for one request.
+
+    If context fits the loaded model's window it is sent as-is. Otherwise
+    each slice is first condensed with map_instruction (up to MAP_WORKERS
+    requests at a time) and the combined notes take context's place in
+    the final request.
+    """
+    max_chars = int(loaded_context_length(cfg) * CHARS_PER_TOKEN * MAP_CONTEXT_FRACTION)
+    if len(context) <= max_chars:
+        return call_lm_studio(
+            cfg, prompt_template.format(context=context), system_prompt=system_prompt, stream=stream
+        )
+
+    slices = split_context(context, max_chars)
+
+    print(f"[INFO] Context split into {len(slices)} parts; summarizing each first.", file=sys.stderr)
+
+    def condense(part: str) -> str:
+        return call_lm_studio(cfg, f"{map_instruction}\n\n{part}", system_prompt=system_prompt)
+
+    with ThreadPoolExecutor(max_workers=min(len(slices), MAP_WORKERS)) as pool:
+        notes = list(pool.map(condense, slices))
+
+    combined = "\n\n".join(f"Notes from part {i}:\n{note}" for i, note in enumerate(notes, 1))
+    return call_lm_studio(
+        cfg, prompt_template.format(context=combined), system_prompt=system_prompt, stream=stream
+    )
+
+
+def encode_log_record(record: dict, path: pathlib.Path) -> bytes:
+    """
+    Serialize one conversation log record for appending to path.
+
+    Records are a LOG_HEADER (marker, body length, CRC32 of the body)
+    followed by the msgpack body. A log path ending in .jsonl keeps the
+    older one-JSON-object-per-line format instead.
+    """
+    if path.suffix == ".jsonl":
+        return orjson.dumps(record) + b"\n"
+    body = msgpack.packb(record, use_bin_type=True)
+    return LOG_HEADER.pack(LOG_MAGIC, len(body), zlib.crc32(body)) + body
+
+
+def append_log_records(path: pathlib.Path, records) -> None:
+    """
+    Append records to the conversation log at path in one write.
+
+    The CLI, router, brain_api and every server worker append to the same
+    file, so the write is done under an exclusive flock (where available)
+    to keep records from different processes from interleaving.
+    """
+    data = b"".join(encode_log_record(r, path) for r in records)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("ab") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.write(data)
+            f.flush()
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
 def log_interaction(
     user_prompt: str,
     final_user_message: str,
@@ -107,9 +514,8 @@ def log_interaction(
     rag_context: str | None,
     cfg: dict,
 ):
-    """Append a single interaction to data/conversations.jsonl."""
+    """Append a single interaction to the conversation log (data/conversations.mpk)."""
     try:
-        DATA_DIR.mkdir(parents=True, exist_ok=True)
         lm_cfg = cfg.get("lm_studio", {})
         model = lm_cfg.get("model", "unknown")
 
@@ -128,8 +534,7 @@ def log_interaction(
             "assistant_reply": assistant_reply,
         }
 
-        with LOG_PATH.open("a", encoding="utf-8") as f:
-            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        append_log_records(LOG_PATH, [record])
 
     except Exception as e:
         # Logging should never crash your main workflow.
@@ -164,51 +569,21 @@ def main(argv=None):
 
     cfg = load_config()
 
-    system_parts = [
-        "You are my local AI assistant. Your goal is to help me solve problems efficiently.",
-        "You have access to a retrieval index of my past ChatGPT conversations and personal technical notes.",
-        "Use retrieved context when it is clearly relevant and improves precision, otherwise rely on general reasoning.",
-        "Keep answers concise, technically accurate, and directly actionable.",
-        "If the query depends on missing details, ask for the minimal clarification needed.",
-        "Avoid hallucinating; if uncertain, state the uncertainty and suggest a safe next action.",
-    ]
-
+    system_prompt = SYSTEM_PROMPT_CLI
     if args.system:
         path = pathlib.Path(args.system).expanduser()
         if path.exists():
-            system_parts.append(path.read_text(encoding='utf-8'))
+            system_prompt += "\n\n" + path.read_text(encoding='utf-8')
         else:
             print(f"[WARN] System prompt file not found: {path}", file=sys.stderr)
 
-
-    system_prompt = "\n\n".join(system_parts)
-
     used_rag_flag = False          # did we actually include retrieved context?
     rag_context_text = ""          # store context separately for logging
 
     if args.no_rag:
         final_user_message = user_prompt
     else:
-        collection = get_collection(cfg)
-        context = retrieve_context(collection, user_prompt, cfg)
-        if context:
-            used_rag_flag = True
-            rag_context_text = context
-
-            final_user_message = textwrap.dedent(
-                f"""\
-                Use the following retrieved context to answer the question if it is relevant.
-                If it is not relevant, ignore it and answer normally.
-
-                ### Retrieved context
-                {context}
-
-                ### Question
-                {user_prompt}
-                """
-            ).strip()
-        else:
-            final_user_message = user_prompt
+        final_user_message, rag_context_text, used_rag_flag = build_rag_message(user_prompt, cfg)
 
 
     # Call the model
@@ -1,15 +1,15 @@
 #!/usr/bin/env python3
 import pathlib
-import yaml
 import requests
 
+from brain_settings import load_yaml
+
 HERE = pathlib.Path(__file__).resolve().parent
 CONFIG_PATH = HERE / "config.yaml"
 
 
 def load_config():
-    with open(CONFIG_PATH, "r") as f:
-        return yaml.safe_load(f)
+    return load_yaml(CONFIG_PATH)
 
 
 def main():
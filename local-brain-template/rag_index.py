@@ -1,22 +1,39 @@
 #!/usr/bin/env python3
+import contextlib
 import os
-import json
+import mmap
+import hashlib
 import pathlib
-from typing import List, Dict, Any
+import threading
+from typing import List, Any
 
-import yaml
+import orjson
+import torch
 import chromadb
 from chromadb.config import Settings
 from sentence_transformers import SentenceTransformer
 
+from brain_settings import load_yaml, open_chroma_collection
+
 
 HERE = pathlib.Path(__file__).resolve().parent
 CONFIG_PATH = HERE / "config.yaml"
 
+EMBED_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+# Chunks gathered per model.encode() call, the batch size encode() uses
+# internally, and rows per collection.upsert()/delete() call.
+ENCODE_WINDOW = 4096
+ENCODE_BATCH_SIZE = 256
+WRITE_BATCH_SIZE = 250
+# Export files at least this big are parsed from an mmap instead of read().
+MMAP_THRESHOLD = 64 * 1024 * 1024
+# INT8 dynamic-quantized ONNX export shipped in the model's hub repo; used
+# when config.yaml sets rag.embedding_backend: onnx.
+DEFAULT_ONNX_FILE = "onnx/model_quint8_avx2.onnx"
+
 
 def load_config() -> dict:
-    with open(CONFIG_PATH, "r") as f:
-        return yaml.safe_load(f)
+    return load_yaml(CONFIG_PATH)
 
 
 def iter_chatgpt_messages(export_dir: pathlib.Path):
@@ -38,8 +55,13 @@ def iter_chatgpt_messages(export_dir: pathlib.Path):
 
     for path in files:
         try:
-            with open(path, "r", encoding="utf-8") as f:
-                data = json.load(f)
+            with open(path, "rb") as f:
+                if path.stat().st_size >= MMAP_THRESHOLD:
+                    # Parse straight from the page cache, no extra copy of the file.
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                        data = orjson.loads(view)
+                else:
+                    data = orjson.loads(f.read())
         except Exception as e:
             print(f"[WARN] Failed to load {path}: {e}")
             continue
@@ -57,7 +79,7 @@ def iter_chatgpt_messages(export_dir: pathlib.Path):
                 role = msg.get("author", {}).get("role", "unknown")
                 content_parts = msg.get("content", {}).get("parts") or []
                 text = "\n\n".join(
-                    p for p in content_parts if isinstance(p, str)
+                    [p for p in content_parts if isinstance(p, str)]
                 ).strip()
                 if text:
                     yield title, role, text
@@ -74,7 +96,7 @@ def iter_chatgpt_messages(export_dir: pathlib.Path):
                     role = msg.get("author", {}).get("role", "unknown")
                     content_parts = msg.get("content", {}).get("parts") or []
                     text = "\n\n".join(
-                        p for p in content_parts if isinstance(p, str)
+                        [p for p in content_parts if isinstance(p, str)]
                     ).strip()
                     if text:
                         yield title, role, text
@@ -90,19 +112,126 @@ def chunk_text(text: str, max_chars: int = 1000) -> List[str]:
 
     chunks = []
     current = []
+    current_len = 0
 
+    def flush():
+        chunk = "\n".join(current).strip()
+        if chunk:
+            chunks.append(chunk)
+
+    # Split on "\n" only (not str.splitlines(), which also breaks on \r,
+    # \x0c, \u2028, ...): chunk ids hash the chunk text, so different
+    # boundaries would re-embed every affected chunk of an existing index.
     for line in text.split("\n"):
-        if sum(len(x) for x in current) + len(line) + 1 > max_chars and current:
-            chunks.append("\n".join(current).strip())
-            current = []
+        # A single line longer than the budget gets hard-split.
+        while len(line) > max_chars:
+            if current:
+                flush()
+                current, current_len = [], 0
+            piece = line[:max_chars].strip()
+            if piece:
+                chunks.append(piece)
+            line = line[max_chars:]
+
+        if current_len + len(line) + 1 > max_chars and current:
+            flush()
+            current, current_len = [], 0
         current.append(line)
+        # Sum of line lengths without the joining newlines, as the check
+        # above always compared; counting them would move boundaries too.
+        current_len += len(line)
 
     if current:
-        chunks.append("\n".join(current).strip())
+        flush()
 
     return chunks
 
 
+def load_embedding_model(cfg: dict | None = None) -> SentenceTransformer:
+    """
+    Load the embedding model on CUDA when available, else on CPU.
+
+    CPU-only hosts can set rag.embedding_backend: onnx to run the INT8
+    quantized MiniLM through ONNX Runtime instead of FP32 PyTorch (needs
+    `pip install sentence-transformers[onnx]`). Output is the same 384-dim
+    normalized vectors. rag.onnx_model_file picks another export, e.g.
+    onnx/model_qint8_avx512_vnni.onnx.
+    """
+    rag_cfg = (cfg or {}).get("rag", {})
+    if rag_cfg.get("embedding_backend") == "onnx":
+        onnx_file = rag_cfg.get("onnx_model_file", DEFAULT_ONNX_FILE)
+        print(f"[INFO] Loading ONNX embedding model ({onnx_file})…")
+        return SentenceTransformer(
+            EMBED_MODEL_NAME,
+            backend="onnx",
+            model_kwargs={"file_name": onnx_file},
+        )
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    print(f"[INFO] Loading embedding model on {device} (this can take a moment)…")
+    return SentenceTransformer(EMBED_MODEL_NAME, device=device)
+
+
+# Process-wide embedder shared with query-time code (llm_rag_cli), so the
+# model is loaded once and queries are embedded exactly like documents.
+_EMBEDDER = None
+_EMBEDDER_LOCK = threading.Lock()
+
+
+def get_embedder(cfg: dict | None = None) -> SentenceTransformer:
+    """Return the shared embedding model, loading it on first use."""
+    global _EMBEDDER
+    if _EMBEDDER is None:
+        with _EMBEDDER_LOCK:
+            if _EMBEDDER is None:
+                _EMBEDDER = load_embedding_model(cfg)
+    return _EMBEDDER
+
+
+def configure_torch_for_indexing() -> None:
+    """
+    Torch settings for the long indexing pass: TF32 matmuls on Ampere+ GPUs,
+    and on CPU one thread per physical core (roughly cpu_count // 2) instead
+    of oversubscribing hyperthreads.
+    """
+    torch.set_float32_matmul_precision("high")
+    if not torch.cuda.is_available():
+        torch.set_num_threads(max(1, (os.cpu_count() or 2) // 2))
+
+
+def _encode_autocast():
+    # BF16 halves the work for MiniLM with no visible retrieval change.
+    if torch.cuda.is_available() and torch.cuda.is_bf16_supported():
+        return torch.autocast("cuda", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def index_batch(model, collection, docs, metadatas, ids) -> None:
+    """Encode one window of chunks and upsert it into the collection."""
+    with torch.inference_mode(), _encode_autocast():
+        embeddings = model.encode(
+            docs,
+            batch_size=ENCODE_BATCH_SIZE,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=True,
+        )
+    for start in range(0, len(docs), WRITE_BATCH_SIZE):
+        end = start + WRITE_BATCH_SIZE
+        collection.upsert(
+            documents=docs[start:end],
+            embeddings=embeddings[start:end],
+            metadatas=metadatas[start:end],
+            ids=ids[start:end],
+        )
+
+
+def chunk_id(title: str, role: str, index: int, chunk: str) -> str:
+    """Stable id for a chunk: unchanged export content maps to the same id."""
+    digest = hashlib.sha1(f"{title}|{role}|{index}|{chunk}".encode("utf-8")).hexdigest()
+    return "cg-" + digest[:20]
+
+
 def build_index():
     cfg = load_config()
     export_dir = pathlib.Path(cfg["chatgpt_export_dir"]).expanduser()
@@ -114,65 +243,82 @@ def build_index():
     print(f"[INFO] Using export dir: {export_dir}")
     print(f"[INFO] Using index dir:  {index_dir}")
 
-    client = chromadb.PersistentClient(
-        path=str(index_dir),
-        settings=Settings(allow_reset=False)
-    )
+    configure_torch_for_indexing()
 
-    collection = client.get_or_create_collection(name=collection_name)
+    use_faiss = cfg["rag"].get("vector_store") == "faiss"
+    if use_faiss:
+        from vector_store import FaissStore
+
+        collection = FaissStore(index_dir, collection_name)
+    else:
+        client = chromadb.PersistentClient(
+            path=str(index_dir),
+            settings=Settings(allow_reset=False)
+        )
+        collection = open_chroma_collection(client, collection_name)
 
-    print(f"[INFO] Clearing existing chatgpt_export docs in '{collection_name}'")
     try:
-        # Only delete docs that came from the ChatGPT export,
-        # keep anything else (like live_cli ingested later)
-        collection.delete(where={"source": "chatgpt_export"})
-    except Exception:
-        pass
-
-    # Embedding model
-    print("[INFO] Loading embedding model (this can take a moment)…")
-    model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
-
-    docs: List[str] = []
-    metadatas: List[Dict[str, Any]] = []
-    ids: List[str] = []
-
-    doc_id = 0
-    for title, role, text in iter_chatgpt_messages(export_dir):
-        for chunk in chunk_text(text):
-            docs.append(chunk)
-            metadatas.append(
-                {
+        # Chunk ids are content hashes, so anything already in the index is
+        # unchanged and can be skipped; only new/changed chunks get embedded.
+        existing = set(
+            collection.get(where={"source": "chatgpt_export"}, include=[])["ids"]
+        )
+        print(f"[INFO] {len(existing)} chatgpt_export chunks already in '{collection_name}'")
+
+        model = None  # loaded on first use; an up-to-date index never needs it
+        seen = set()
+
+        # One window of chunks, filled in place and reused after every flush
+        # instead of growing fresh lists per window.
+        docs: List[Any] = [None] * ENCODE_WINDOW
+        metadatas: List[Any] = [None] * ENCODE_WINDOW
+        ids: List[Any] = [None] * ENCODE_WINDOW
+        idx = 0
+
+        new_chunks = 0
+        for title, role, text in iter_chatgpt_messages(export_dir):
+            for i, chunk in enumerate(chunk_text(text)):
+                cid = chunk_id(title, role, i, chunk)
+                if cid in seen:
+                    continue
+                seen.add(cid)
+                if cid in existing:
+                    continue
+
+                docs[idx] = chunk
+                metadatas[idx] = {
                     "source": "chatgpt_export",
                     "conversation_title": title,
                     "role": role,
                 }
-            )
-            ids.append(f"chatgpt-{doc_id}")
-            doc_id += 1
-
-            if len(docs) >= 128:
-                # Batch insert
-                embeddings = model.encode(docs, show_progress_bar=False).tolist()
-                collection.add(
-                    documents=docs,
-                    embeddings=embeddings,
-                    metadatas=metadatas,
-                    ids=ids,
-                )
-                print(f"[INFO] Indexed {doc_id} chunks…")
-                docs, metadatas, ids = [], [], []
-
-    # Final flush
-    if docs:
-        embeddings = model.encode(docs, show_progress_bar=False).tolist()
-        collection.add(
-            documents=docs,
-            embeddings=embeddings,
-            metadatas=metadatas,
-            ids=ids,
-        )
-        print(f"[INFO] Indexed {doc_id} chunks total.")
+                ids[idx] = cid
+                idx += 1
+                new_chunks += 1
+
+                if idx == ENCODE_WINDOW:
+                    model = model or get_embedder(cfg)
+                    index_batch(model, collection, docs, metadatas, ids)
+                    print(f"[INFO] Indexed {new_chunks} new chunks…")
+                    idx = 0
+
+        # Final flush
+        if idx:
+            model = model or get_embedder(cfg)
+            index_batch(model, collection, docs[:idx], metadatas[:idx], ids[:idx])
+        print(f"[INFO] Indexed {new_chunks} new chunks total.")
+
+        # Drop chunks whose conversation/message no longer exists in the export.
+        stale = list(existing - seen)
+        for start in range(0, len(stale), WRITE_BATCH_SIZE):
+            collection.delete(ids=stale[start:start + WRITE_BATCH_SIZE])
+        if stale:
+            print(f"[INFO] Removed {len(stale)} stale chunks.")
+
+        if use_faiss:
+            collection.save()
+    finally:
+        if use_faiss:
+            collection.close()
 
     print("[INFO] Index build complete.")
 
@@ -14,25 +14,49 @@ Endpoints (JSON):
 """
 
 from pathlib import Path
-import subprocess
+import asyncio
+import importlib
+import io
+import sys
+import threading
 from typing import Optional, List
-import json
 from datetime import datetime, timezone
-from fastapi import FastAPI, HTTPException
+import orjson
+from fastapi import BackgroundTasks, FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
 # Reuse your existing helpers from llm_rag_cli
 from llm_rag_cli import (
     load_config,
-    get_collection,
-    retrieve_context,
+    build_rag_message,
+    clear_retrieval_cache,
+    append_log_records,
     call_lm_studio,
+    call_lm_studio_stream,
 )
 
 HERE = Path(__file__).resolve().parent
 DATA_DIR = HERE / "data"
 PROFILE_PATH = HERE / "profile.md"
-LOG_PATH = DATA_DIR / "conversations.jsonl"
+LOG_PATH = DATA_DIR / "conversations.mpk"
+SYSTEM_PROMPT_ROUTER = (
+    "You are my local AI assistant running behind a router API.\n"
+    "Use retrieved context when it clearly helps; otherwise rely on general reasoning.\n"
+    "Be concise, technically accurate, and directly actionable.\n"
+)
+SYSTEM_PROMPT_OPENWEBUI = (
+    "You are my local AI assistant accessed via Open WebUI.\n"
+    "You have access to a RAG memory of my past conversations and notes.\n"
+    "Use retrieved context when clearly helpful; otherwise answer normally.\n"
+    "Be concise, technically accurate, and directly actionable.\n"
+)
+# Joins SYSTEM_PROMPT_OPENWEBUI and any system messages sent by the UI.
+_UI_INSTRUCTIONS_PREFIX = "\n\nAdditional instructions from the UI:\n"
+
+# How many of the most recent user turns /v1/chat/completions retrieves for.
+RAG_RECENT_TURNS = 3
 
 
 app = FastAPI(title="Local RAG + LM Studio Router", version="0.1.0")
@@ -50,36 +74,73 @@ class ChatResponse(BaseModel):
     model: str
 
 
-def run_script(script_name: str) -> str:
+# Scripts share state files (ingest state, profile.md), so only one
+# in-process script runs at a time.
+_RUN_LOCK = threading.Lock()
+# Output buffer of the run_module() call on the current thread, if any.
+_CAPTURE = threading.local()
+
+
+class _ThreadRoutedStream:
     """
-    Run a Python script in this project using the same interpreter as the server.
-    Captures stdout and stderr and returns combined text.
+    Stand-in for sys.stdout/sys.stderr: writes from a thread inside
+    run_module() go to that run's buffer, writes from every other thread
+    (request handlers, uvicorn) still reach the real stream.
     """
-    cmd = ["python", str(HERE / script_name)]
-    try:
-        proc = subprocess.run(
-            cmd,
-            cwd=str(HERE),
-            capture_output=True,
-            text=True,
-            check=False,
-        )
-        out = proc.stdout.strip()
-        err = proc.stderr.strip()
-        combined = ""
-        if out:
-            combined += out
-        if err:
-            if combined:
-                combined += "\n\n"
-            combined += f"[stderr]\n{err}"
-        return combined or "(no output)"
-    except Exception as e:
-        return f"[ERROR] Failed to run {script_name}: {e!r}"
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def _target(self):
+        buf = getattr(_CAPTURE, "buf", None)
+        return self._stream if buf is None else buf
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    def isatty(self):
+        return getattr(_CAPTURE, "buf", None) is None and self._stream.isatty()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+def _install_output_routing() -> None:
+    if not isinstance(sys.stdout, _ThreadRoutedStream):
+        sys.stdout = _ThreadRoutedStream(sys.stdout)
+    if not isinstance(sys.stderr, _ThreadRoutedStream):
+        sys.stderr = _ThreadRoutedStream(sys.stderr)
+
+
+def run_module(module_name: str) -> str:
+    """
+    Run a project script's main() inside this server process.
+    Captures the stdout and stderr of this call's thread and returns the
+    combined text; raises RuntimeError (with that text) if the script fails.
+
+    The module is imported on first use and stays loaded, so later runs skip
+    interpreter startup and the chromadb / sentence-transformers imports.
+    """
+    buf = io.StringIO()
+    with _RUN_LOCK:
+        _install_output_routing()
+        _CAPTURE.buf = buf
+        try:
+            module = importlib.import_module(module_name)
+            module.main()
+        except (Exception, SystemExit) as e:
+            out = buf.getvalue().strip()
+            raise RuntimeError(f"{out}\n\n[ERROR] Failed to run {module_name}: {e!r}".lstrip()) from e
+        finally:
+            _CAPTURE.buf = None
+    return buf.getvalue().strip() or "(no output)"
 
 
 @app.get("/health")
-def health():
+async def health():
     """
     Very simple health check: verify config loads and index dir exists.
     (For a deeper health check, you can add an LM Studio ping.)
@@ -97,10 +158,13 @@ def health():
         raise HTTPException(status_code=500, detail=f"Health check failed: {e!r}")
 
 @app.post("/chat", response_model=ChatResponse)
-def chat(req: ChatRequest):
+async def chat(req: ChatRequest, background_tasks: BackgroundTasks):
     """
     Chat endpoint. Optionally uses RAG.
     Intended for API callers (e.g. n8n, scripts).
+
+    Chroma and LM Studio calls block, so they run in worker threads and the
+    event loop keeps serving other requests meanwhile.
     """
     cfg = load_config()
     model_name = req.model or cfg["lm_studio"]["model"]
@@ -110,33 +174,22 @@ def chat(req: ChatRequest):
     rag_context_text = ""
 
     if req.use_rag:
-        collection = get_collection(cfg)
-        context = retrieve_context(collection, req.prompt, cfg)
-        if context:
-            used_rag_flag = True
-            rag_context_text = context
-            final_user_message = (
-                "Use the following retrieved context to answer the question if it is relevant.\n"
-                "If it is not relevant, ignore it and answer normally.\n\n"
-                "### Retrieved context\n"
-                f"{context}\n\n"
-                "### Question\n"
-                f"{req.prompt}"
-            )
-
-    reply = call_lm_studio(
+        final_user_message, rag_context_text, used_rag_flag = await asyncio.to_thread(
+            build_rag_message, req.prompt, cfg
+        )
+
+    reply = await asyncio.to_thread(
+        call_lm_studio,
         cfg,
         final_user_message,
-        system_prompt=(
-            "You are my local AI assistant running behind a router API.\n"
-            "Use retrieved context when it clearly helps; otherwise rely on general reasoning.\n"
-            "Be concise, technically accurate, and directly actionable.\n"
-        ),
+        system_prompt=SYSTEM_PROMPT_ROUTER,
         model=model_name,
     )
 
-    # Log as a web interaction (source='web'), since this is typically used by UIs / external tools
-    log_interaction_web(
+    # Log as a web interaction (source='web'), since this is typically used by UIs / external tools.
+    # Runs after the response is sent so disk I/O never delays the reply.
+    background_tasks.add_task(
+        log_interaction_web,
         user_prompt=req.prompt,
         sent_prompt=final_user_message,
         assistant_reply=reply,
@@ -169,12 +222,13 @@ class OpenAIChatCompletionRequest(BaseModel):
 
 
 @app.post("/v1/chat/completions")
-def openai_chat_completions(req: OpenAIChatCompletionRequest):
+async def openai_chat_completions(req: OpenAIChatCompletionRequest, background_tasks: BackgroundTasks):
     """
     OpenAI-compatible chat completions endpoint for Open WebUI.
 
     - Uses all user messages concatenated as the 'prompt'
-    - Uses RAG by default
+    - Uses RAG by default, retrieving for the last few user turns in one
+      batched lookup
     """
     cfg = load_config()
     model_name = req.model or cfg["lm_studio"]["model"]
@@ -195,44 +249,40 @@ def openai_chat_completions(req: OpenAIChatCompletionRequest):
     if not user_prompt:
         raise HTTPException(status_code=400, detail="No user content found in messages")
 
-    used_rag_flag = False
-    final_user_message = user_prompt
-    rag_context_text = ""
-
     # Always use RAG here; we want Open WebUI chats to use the brain.
-    collection = get_collection(cfg)
-    context = retrieve_context(collection, user_prompt, cfg)
-    if context:
-        used_rag_flag = True
-        rag_context_text = context
-        final_user_message = (
-            "Use the following retrieved context to answer the question if it is relevant.\n"
-            "If it is not relevant, ignore it and answer normally.\n\n"
-            "### Retrieved context\n"
-            f"{context}\n\n"
-            "### Question\n"
-            f"{user_prompt}"
-        )
-
-    base_system_prompt = (
-        "You are my local AI assistant accessed via Open WebUI.\n"
-        "You have access to a RAG memory of my past conversations and notes.\n"
-        "Use retrieved context when clearly helpful; otherwise answer normally.\n"
-        "Be concise, technically accurate, and directly actionable.\n"
+    recent_turns = [p for p in reversed(user_parts) if p.strip()][:RAG_RECENT_TURNS]
+    final_user_message, rag_context_text, used_rag_flag = await asyncio.to_thread(
+        build_rag_message, user_prompt, cfg, recent_turns
     )
-    full_system_prompt = base_system_prompt
+
+    full_system_prompt = SYSTEM_PROMPT_OPENWEBUI
     if system_prompt_extra:
-        full_system_prompt += "\n\nAdditional instructions from the UI:\n" + system_prompt_extra
+        full_system_prompt += _UI_INSTRUCTIONS_PREFIX + system_prompt_extra
+
+    if req.stream:
+        return StreamingResponse(
+            stream_openai_chunks(
+                cfg,
+                final_user_message,
+                full_system_prompt,
+                model_name,
+                user_prompt=user_prompt,
+                used_rag=used_rag_flag,
+            ),
+            media_type="text/event-stream",
+        )
 
-    reply = call_lm_studio(
+    reply = await asyncio.to_thread(
+        call_lm_studio,
         cfg,
         final_user_message,
         system_prompt=full_system_prompt,
         model=model_name,
     )
 
-    # Log the interaction
-    log_interaction_web(
+    # Log the interaction once the response has been sent
+    background_tasks.add_task(
+        log_interaction_web,
         user_prompt=user_prompt,
         sent_prompt=final_user_message,
         assistant_reply=reply,
@@ -263,6 +313,50 @@ def openai_chat_completions(req: OpenAIChatCompletionRequest):
     }
     return resp
 
+def stream_openai_chunks(
+    cfg: dict,
+    final_user_message: str,
+    system_prompt: str,
+    model_name: str,
+    user_prompt: str,
+    used_rag: bool,
+):
+    """
+    Relay LM Studio's streamed reply as OpenAI `chat.completion.chunk` SSE
+    events. The full reply is logged once the stream ends (or is cut off).
+    """
+    import time
+    created = int(time.time())
+    chunk_id = f"chatcmpl-router-{int(time.time()*1000)}"
+
+    def sse(delta: dict, finish_reason: Optional[str] = None) -> bytes:
+        chunk = {
+            "id": chunk_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model_name,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        return b"data: " + orjson.dumps(chunk) + b"\n\n"
+
+    parts = []
+    try:
+        yield sse({"role": "assistant"})
+        for piece in call_lm_studio_stream(cfg, final_user_message, system_prompt, model=model_name):
+            parts.append(piece)
+            yield sse({"content": piece})
+        yield sse({}, finish_reason="stop")
+        yield b"data: [DONE]\n\n"
+    finally:
+        log_interaction_web(
+            user_prompt=user_prompt,
+            sent_prompt=final_user_message,
+            assistant_reply="".join(parts),
+            used_rag=used_rag,
+            model_name=model_name,
+        )
+
+
 def log_interaction_web(
     user_prompt: str,
     sent_prompt: str,
@@ -270,9 +364,8 @@ def log_interaction_web(
     used_rag: bool,
     model_name: str,
 ):
-    """Append a web (OpenWebUI) interaction to data/conversations.jsonl."""
+    """Append a web (OpenWebUI) interaction to data/conversations.mpk."""
     try:
-        DATA_DIR.mkdir(parents=True, exist_ok=True)
         record = {
             "timestamp": datetime.now(timezone.utc).isoformat(),
             "source": "web",
@@ -283,8 +376,7 @@ def log_interaction_web(
             "rag_context": "",  # we'll fill this in if we have explicit context
             "assistant_reply": assistant_reply,
         }
-        with LOG_PATH.open("a", encoding="utf-8") as f:
-            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        append_log_records(LOG_PATH, [record])
     except Exception as e:
         # Logging must never break the main flow
         print(f"[WARN] Failed to log web interaction: {e}", flush=True)
@@ -292,20 +384,30 @@ def log_interaction_web(
 
 
 @app.post("/ingest")
-def ingest():
+async def ingest():
     """
-    Run ingest_conversations.py to add new logged CLI conversations into RAG.
+    Run _alpha/ingest_conversations.py to add new logged conversations into RAG.
     """
-    output = run_script("ingest_conversations.py")
+    try:
+        output = await run_in_threadpool(run_module, "_alpha.ingest_conversations")
+    except RuntimeError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        # New documents may change what any cached query should retrieve,
+        # even if the run failed part-way.
+        clear_retrieval_cache()
     return {"status": "ok", "output": output}
 
 
 @app.post("/profile/regenerate")
-def profile_regenerate():
+async def profile_regenerate():
     """
     Regenerate profile.md from current RAG state.
     """
-    output = run_script("generate_profile.py")
+    try:
+        output = await run_in_threadpool(run_module, "generate_profile")
+    except RuntimeError as e:
+        raise HTTPException(status_code=500, detail=str(e))
     return {"status": "ok", "output": output}
 
 
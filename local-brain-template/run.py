@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+run.py
+
+Serve the router (or brain_api) with uvicorn using uvloop + httptools when
+they are installed, optionally with several worker processes.
+
+Each worker opens the Chroma collection and loads its own copy of the
+embedding model (and, on GPU, its own CUDA context next to LM Studio), so
+extra workers cost real memory. /ingest and /profile/regenerate are only
+serialized within one process: with more than one worker, two concurrent
+/ingest calls can ingest the same records twice, so keep a single worker
+if you use them.
+
+Usage:
+  python run.py                      # router:app on 0.0.0.0:8001, 1 worker
+  python run.py --app brain_api:app --workers 2
+"""
+
+import argparse
+import importlib.util
+
+import uvicorn
+
+
+def pick_impl(module_name: str) -> str:
+    """Return module_name if it can be imported, else uvicorn's "auto"."""
+    if importlib.util.find_spec(module_name) is None:
+        print(f"[WARN] {module_name} not installed; falling back to uvicorn's default.")
+        return "auto"
+    return module_name
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the Local Brain HTTP API with uvicorn.")
+    parser.add_argument("--app", default="router:app", help="ASGI app import string (default: router:app)")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help=(
+            "Worker processes (default: 1). Each loads its own embedding model, "
+            "and /ingest is not safe to run from more than one process."
+        ),
+    )
+    args = parser.parse_args()
+
+    print(f"[INFO] Serving {args.app} on {args.host}:{args.port} with {args.workers} worker(s)")
+    uvicorn.run(
+        args.app,
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        loop=pick_impl("uvloop"),
+        http=pick_impl("httptools"),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -15,16 +15,50 @@ Interactive setup wizard for Local Brain.
 
 from __future__ import annotations
 
+import json
+import os
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import textwrap
 import yaml
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from brain_settings import YAML_DUMPER
 
 
 ROOT = Path(__file__).resolve().parent
 CONFIG_PATH = ROOT / "config.yaml"
 
+# Last good LM Studio /models response, so repeat runs (and offline runs)
+# don't need the server. LOCAL_BRAIN_MODELS_TTL overrides the age in
+# seconds after which it is refreshed; LOCAL_BRAIN_DISABLE_REMOTE_MODELS=1
+# never contacts the server and relies on the cache alone.
+MODELS_CACHE_DIR = Path.home() / ".local-brain" / "cache"
+MODELS_CACHE_TTL = int(os.environ.get("LOCAL_BRAIN_MODELS_TTL", 24 * 60 * 60))
+# Per-probe timeout; a local LM Studio answers in milliseconds.
+PROBE_TIMEOUT = 1.5
+
+# Keep-alive pool for the endpoint probes. Only 502/503/504 (e.g. LM Studio
+# still loading a model) are retried with backoff; connection errors and
+# read timeouts are not, so a server that is down or hung is still reported
+# within PROBE_TIMEOUT.
+_RETRY = Retry(
+    total=3,
+    connect=0,
+    read=0,
+    other=0,
+    backoff_factor=2,
+    status_forcelist=[502, 503, 504],
+    raise_on_status=False,
+)
+_SESSION = requests.Session()
+_SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=_RETRY))
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=_RETRY))
+
 
 BANNER = r"""
   _                _        ____             _       
@@ -38,6 +72,21 @@ BANNER = r"""
 """
 
 
+_NEXT_STEPS_TMPL = """
+🎉 Setup complete!
+Next steps (typical):
+  1) Create/activate a venv:
+       python -m venv rag && source rag/bin/activate
+  2) Install dependencies:
+       pip install -r requirements.txt
+  3) Run the Brain API:
+       uvicorn brain_api:app --host 0.0.0.0 --port {api_port}
+  4) Run Open WebUI via Docker and point it at:
+       http://<host-ip>:{api_port}/v1
+
+"""
+
+
 def ask(prompt: str, default: str | None = None) -> str:
     if default is not None:
         full = f"{prompt} [{default}]: "
@@ -60,28 +109,86 @@ def yes_no(prompt: str, default: bool = True) -> bool:
         print("Please answer y or n.")
 
 
-def check_lm_studio(base_url: str) -> bool:
+def read_models_cache(cache_dir: Path, base_url: str) -> dict | None:
+    """Return the cached /models entry for base_url, or None."""
+    try:
+        cached = json.loads((cache_dir / "lmstudio_models.json").read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    return cached if cached.get("base_url") == base_url else None
+
+
+def write_models_cache(cache_dir: Path, base_url: str, endpoint: str, models: dict) -> None:
+    """Cache a /models response; endpoint records which URL answered."""
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        (cache_dir / "lmstudio_models.json").write_text(
+            json.dumps({"base_url": base_url, "endpoint": endpoint, "models": models}),
+            encoding="utf-8",
+        )
+        (cache_dir / "last_sync").touch()
+    except OSError as e:
+        print(f"[WARN] Could not write model cache in {cache_dir}: {e}")
+
+
+def check_lm_studio(base_url: str, cache_dir: Path = MODELS_CACHE_DIR) -> str | None:
     """
     Quick sanity check that LM Studio's OpenAI-compatible server is up.
 
-    We hit GET <base_url>/models (or /v1/models if user gave root).
+    Probes <base_url>/models and LM Studio's native /api/v0/models (which
+    also reports context lengths) in parallel and takes the first 200.
+    A model list cached within MODELS_CACHE_TTL is used without a request;
+    if neither endpoint answers, an older cached list is used.
+
+    Returns "probed" if the server answered, "cached" if only the cached
+    model list was used (the server itself was not confirmed), or None.
     """
     url = base_url.rstrip("/")
-    # If they gave http://host:port, append /v1/models
-    if not url.endswith("/v1") and not url.endswith("/v1/"):
-        models_url = url + "/models"
-    else:
-        models_url = url + "/models"
-
+    root = url[:-len("/v1")] if url.endswith("/v1") else url
+    candidates = list(dict.fromkeys([url + "/models", root + "/api/v0/models"]))
+
+    cached = read_models_cache(cache_dir, url)
+    if os.environ.get("LOCAL_BRAIN_DISABLE_REMOTE_MODELS") == "1":
+        if cached is None:
+            print(f"[ERROR] LOCAL_BRAIN_DISABLE_REMOTE_MODELS=1 and no cached model list for {url}")
+            return None
+        return "cached"
+    if cached is not None:
+        try:
+            if time.time() - (cache_dir / "last_sync").stat().st_mtime < MODELS_CACHE_TTL:
+                return "cached"
+        except OSError:
+            pass
+
+    problems = []
+    pool = ThreadPoolExecutor(max_workers=len(candidates))
     try:
-        resp = requests.get(models_url, timeout=5)
-        if resp.status_code == 200:
-            return True
-        print(f"[WARN] LM Studio responded with status {resp.status_code} at {models_url}")
-        return False
-    except Exception as e:
-        print(f"[ERROR] Could not reach LM Studio at {models_url}: {e}")
-        return False
+        futures = {pool.submit(_SESSION.get, u, timeout=PROBE_TIMEOUT): u for u in candidates}
+        for fut in as_completed(futures):
+            models_url = futures[fut]
+            try:
+                resp = fut.result()
+            except requests.RequestException as e:
+                problems.append(f"could not reach {models_url}: {e}")
+                continue
+            if resp.status_code != 200:
+                problems.append(f"status {resp.status_code} at {models_url}")
+                continue
+            try:
+                write_models_cache(cache_dir, url, models_url, resp.json())
+            except ValueError:
+                pass  # reachable, just not a JSON body worth caching
+            return "probed"
+    finally:
+        # Don't wait for the slower probe once one has answered.
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    if cached is not None:
+        print(f"[WARN] LM Studio not reachable ({'; '.join(problems)}); using cached model list.")
+        return "cached"
+    for problem in problems:
+        print(f"[ERROR] LM Studio {problem}")
+    return None
 
 
 def main() -> int:
@@ -103,17 +210,24 @@ def main() -> int:
     lm_model = ask("Default model ID", "openai/gpt-oss-20b")
 
     print("\nChecking LM Studio connectivity...")
-    if not check_lm_studio(lm_base_url):
+    lm_status = check_lm_studio(lm_base_url)
+    if lm_status is None:
         print("\n❌ LM Studio does not appear to be reachable at that URL.")
         print("   Make sure the LM Studio server is running and the URL is correct, then try again.")
         return 1
+    elif lm_status == "cached":
+        print("ℹ️  LM Studio model list loaded from cache; the server itself was not confirmed.\n")
     else:
         print("✅ LM Studio appears reachable.\n")
 
     # --- Base directory (project root) ---
     default_base = str(ROOT)
     base_dir = ask("Project base directory", default_base)
-    base = Path(base_dir).expanduser().resolve()
+    base = Path(base_dir).expanduser()
+    # An existing absolute path is used as given; resolve() would stat every
+    # component, which is slow on network filesystems.
+    if not (base.is_absolute() and base.exists()):
+        base = base.resolve()
 
     # --- Paths relative to base ---
     print("\nProject data paths (relative to base dir):")
@@ -130,14 +244,16 @@ def main() -> int:
         api_port = 8001
 
     # --- Confirm summary ---
-    print("\nSummary:")
-    print(f"  Base dir:        {base}")
-    print(f"  chat_export_dir: {chat_export_dir}")
-    print(f"  index_dir:       {index_dir}")
-    print(f"  data_dir:        {data_dir}")
-    print(f"  LM base_url:     {lm_base_url}")
-    print(f"  LM model:        {lm_model}")
-    print(f"  API port:        {api_port}")
+    summary = (
+        ("Base dir", base),
+        ("chat_export_dir", chat_export_dir),
+        ("index_dir", index_dir),
+        ("data_dir", data_dir),
+        ("LM base_url", lm_base_url),
+        ("LM model", lm_model),
+        ("API port", api_port),
+    )
+    sys.stdout.write("\nSummary:\n" + "".join(f"  {k + ':':<17}{v}\n" for k, v in summary))
 
     if not yes_no("\nDoes this look correct?", True):
         print("Aborting setup. No changes written.")
@@ -162,16 +278,20 @@ def main() -> int:
 
     # --- Write config.yaml ---
     CONFIG_PATH.write_text(
-        yaml.safe_dump(cfg, sort_keys=False),
+        yaml.dump(cfg, Dumper=YAML_DUMPER, sort_keys=False),
         encoding="utf-8",
     )
     print(f"\n✅ Wrote config.yaml → {CONFIG_PATH}")
 
     # --- Create directories ---
-    for rel in (chat_export_dir, index_dir, data_dir):
+    def ensure_dir(rel: str) -> Path:
         p = base / rel
         p.mkdir(parents=True, exist_ok=True)
-        print(f"📁 Ensured directory exists: {p}")
+        return p
+
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        created = list(pool.map(ensure_dir, (chat_export_dir, index_dir, data_dir)))
+    sys.stdout.write("".join(f"📁 Ensured directory exists: {p}\n" for p in created))
 
     # --- requirements.txt (optional) ---
     if yes_no("\nCreate/update requirements.txt in this folder?", True):
@@ -184,6 +304,9 @@ def main() -> int:
             pydantic
             pyyaml
             requests
+            orjson
+            msgpack
+            sentence-transformers
             """
         )
         if req_path.exists():
@@ -192,17 +315,7 @@ def main() -> int:
             req_path.write_text(base_reqs, encoding="utf-8")
             print(f"✅ Wrote basic requirements.txt → {req_path}")
 
-    print("\n🎉 Setup complete!")
-    print("Next steps (typical):")
-    print(f"  1) Create/activate a venv:")
-    print(f"       python -m venv rag && source rag/bin/activate")
-    print(f"  2) Install dependencies:")
-    print(f"       pip install -r requirements.txt")
-    print(f"  3) Run the Brain API:")
-    print(f"       uvicorn brain_api:app --host 0.0.0.0 --port {api_port}")
-    print("  4) Run Open WebUI via Docker and point it at:")
-    print(f"       http://<host-ip>:{api_port}/v1")
-    print("")
+    sys.stdout.write(_NEXT_STEPS_TMPL.format(api_port=api_port))
     return 0
 
 
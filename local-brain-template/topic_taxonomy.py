@@ -5,23 +5,61 @@ topic_taxonomy.py
 Generate a topic taxonomy (buckets) from your RAG index via LM Studio.
 """
 
-from copy import deepcopy
 import textwrap
 
 from llm_rag_cli import (
     load_config,
+    with_rag_overrides,
     get_collection,
     retrieve_context,
-    call_lm_studio,
+    map_reduce_report,
+)
+
+# What to keep from each slice when the context is too big for one request.
+MAP_INSTRUCTION = (
+    "List the main topics and recurring themes in these snippets from my chat history, "
+    "with a few representative examples for each. Be brief; this feeds a later summary."
+)
+
+TAXONOMY_PROMPT = textwrap.dedent(
+    """\
+    You are given context snippets from my personal chat history:
+
+    {context}
+
+    Based ONLY on these snippets (and general reasoning):
+
+    1. Propose a topic taxonomy: 8–15 top-level topics that cover most of the content.
+       Examples of possible topics include: 'Homelab & Proxmox', 'Networking & Firewalls',
+       'Linux desktop optimization', 'Storage & NAS', 'Family life & logistics', etc.
+    2. For each topic, provide:
+       - A short description (what this topic is about for me specifically)
+       - 3–7 representative example subtopics or project types
+    3. Then, add a section 'How to Use This Taxonomy' with practical ideas for:
+       - Organizing notes or an Obsidian vault
+       - Tagging future conversations or documents
+       - Prioritizing which topics matter most for my goals
+    4. Present the output as Markdown, e.g.:
+
+       # Topic Taxonomy
+       ## 1. Topic Name
+       - Description: ...
+       - Representative subtopics:
+         - ...
+         - ...
+
+       ## How to Use This Taxonomy
+       - ...
+
+    Focus on clarity and usefulness; avoid buzzwords.
+    """
 )
 
 
 def main():
     cfg = load_config()
-    cfg_big = deepcopy(cfg)
-    cfg_big.setdefault("rag", {})
-    cfg_big["rag"]["max_context_chars"] = int(
-        cfg_big["rag"].get("max_context_chars", 8000) * 2
+    cfg_big = with_rag_overrides(
+        cfg, max_context_chars=int(cfg.get("rag", {}).get("max_context_chars", 8000) * 2)
     )
 
     collection = get_collection(cfg_big)
@@ -47,43 +85,16 @@ def main():
         ]
     )
 
-    user_message = textwrap.dedent(
-        f"""\
-        You are given context snippets from my personal chat history:
-
-        {context}
-
-        Based ONLY on these snippets (and general reasoning):
-
-        1. Propose a topic taxonomy: 8–15 top-level topics that cover most of the content.
-           Examples of possible topics include: 'Homelab & Proxmox', 'Networking & Firewalls',
-           'Linux desktop optimization', 'Storage & NAS', 'Family life & logistics', etc.
-        2. For each topic, provide:
-           - A short description (what this topic is about for me specifically)
-           - 3–7 representative example subtopics or project types
-        3. Then, add a section 'How to Use This Taxonomy' with practical ideas for:
-           - Organizing notes or an Obsidian vault
-           - Tagging future conversations or documents
-           - Prioritizing which topics matter most for my goals
-        4. Present the output as Markdown, e.g.:
-
-           # Topic Taxonomy
-           ## 1. Topic Name
-           - Description: ...
-           - Representative subtopics:
-             - ...
-             - ...
-
-           ## How to Use This Taxonomy
-           - ...
-
-        Focus on clarity and usefulness; avoid buzzwords.
-        """
+    # Streamed straight to stdout as it is generated.
+    map_reduce_report(
+        cfg_big,
+        context,
+        TAXONOMY_PROMPT,
+        MAP_INSTRUCTION,
+        system_prompt=system_prompt,
+        stream=True,
     )
 
-    report = call_lm_studio(cfg_big, user_message, system_prompt=system_prompt)
-    print(report)
-
 
 if __name__ == "__main__":
     main()
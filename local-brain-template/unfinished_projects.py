@@ -6,25 +6,59 @@ Use the existing RAG + LM Studio pipeline to infer unfinished projects
 from your historical conversations, and output a Markdown report.
 """
 
-from copy import deepcopy
 import textwrap
 
 from llm_rag_cli import (
     load_config,
+    with_rag_overrides,
     get_collection,
     retrieve_context,
-    call_lm_studio,
+    map_reduce_report,
+)
+
+# What to keep from each slice when the context is too big for one request.
+MAP_INSTRUCTION = (
+    "List the projects, tasks, or initiatives in these snippets from my chat history that "
+    "appear unfinished or in progress, with the evidence for each. Be brief; this feeds a "
+    "later summary."
+)
+
+REPORT_PROMPT = textwrap.dedent(
+    """\
+    You are given context from my historical conversations:
+
+    {context}
+
+    Based ONLY on this context:
+
+    1. Identify projects, tasks, or initiatives that appear to be unfinished or in-progress.
+    2. Group them by project (e.g., "Proxmox cluster reconfiguration", "OPNsense VLAN design").
+    3. For each project, list:
+       - A short description (1–2 sentences)
+       - Why you think it is unfinished (evidence from the context)
+       - 3–5 concrete next actions I can take to move it forward.
+    4. If you are unsure whether something is finished, err on the side of including it but mark it as **uncertain**.
+    5. Output in Markdown with clear headings, like:
+
+       # Unfinished Projects
+       ## Project: ...
+       - Status: ...
+       - Evidence: ...
+       - Next actions:
+         - ...
+         - ...
+
+    Do not mention the internal mechanics of RAG or embeddings. Talk as if you just remember my history.
+    """
 )
 
 
 def main():
     cfg = load_config()
 
-    # Make a shallow copy so we can bump context size just for this report
-    cfg_big = deepcopy(cfg)
-    cfg_big.setdefault("rag", {})
-    cfg_big["rag"]["max_context_chars"] = int(
-        cfg_big["rag"].get("max_context_chars", 8000) * 2
+    # Bump context size just for this report
+    cfg_big = with_rag_overrides(
+        cfg, max_context_chars=int(cfg.get("rag", {}).get("max_context_chars", 8000) * 2)
     )
 
     collection = get_collection(cfg_big)
@@ -52,38 +86,16 @@ def main():
         ]
     )
 
-    user_message = textwrap.dedent(
-        f"""\
-        You are given context from my historical conversations:
-
-        {context}
-
-        Based ONLY on this context:
-
-        1. Identify projects, tasks, or initiatives that appear to be unfinished or in-progress.
-        2. Group them by project (e.g., "Proxmox cluster reconfiguration", "OPNsense VLAN design").
-        3. For each project, list:
-           - A short description (1–2 sentences)
-           - Why you think it is unfinished (evidence from the context)
-           - 3–5 concrete next actions I can take to move it forward.
-        4. If you are unsure whether something is finished, err on the side of including it but mark it as **uncertain**.
-        5. Output in Markdown with clear headings, like:
-
-           # Unfinished Projects
-           ## Project: ...
-           - Status: ...
-           - Evidence: ...
-           - Next actions:
-             - ...
-             - ...
-
-        Do not mention the internal mechanics of RAG or embeddings. Talk as if you just remember my history.
-        """
+    # Streamed straight to stdout as it is generated.
+    map_reduce_report(
+        cfg_big,
+        context,
+        REPORT_PROMPT,
+        MAP_INSTRUCTION,
+        system_prompt=system_prompt,
+        stream=True,
     )
 
-    report = call_lm_studio(cfg_big, user_message, system_prompt=system_prompt)
-    print(report)
-
 
 if __name__ == "__main__":
     main()
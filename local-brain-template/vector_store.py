@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+vector_store.py
+
+FAISS-backed alternative to a Chroma collection, enabled with
+`rag: vector_store: faiss` in config.yaml.
+
+Vectors live in an exact inner-product index (<collection>.faiss; with
+normalized embeddings that is cosine similarity) and documents/metadata in
+a SQLite sidecar (<collection>.sqlite3) in the index dir. FaissStore
+implements the part of the Chroma collection API this project uses
+(add/upsert/get/delete/query/count), so callers work with either backend.
+
+Writes become visible to other processes on save(); read-only stores
+reopen the index file when it changes. The flat index is read fully into
+RAM (4 bytes per dimension per vector, ~1.5 KB per MiniLM chunk).
+
+Every writer loads the whole index, changes it in memory and rewrites the
+file, so two at once (e.g. a rag_watch rebuild and an /ingest) would lose
+one's vectors. A writable store therefore holds an exclusive lock on
+<collection>.lock from open until close().
+"""
+
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+import faiss
+import numpy as np
+import orjson
+
+try:
+    import fcntl
+except ImportError:  # Windows: no flock, so writers must not overlap
+    fcntl = None
+
+# Stay under SQLite's bound-parameter limit for `IN (...)` lookups.
+SQL_CHUNK = 900
+
+
+class FaissStore:
+    def __init__(self, index_dir: Path, name: str, read_only: bool = False):
+        index_dir = Path(index_dir)
+        index_dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = index_dir / f"{name}.faiss"
+        self.read_only = read_only
+        self._lock_file = None
+        if not read_only:
+            self._acquire_writer_lock(index_dir / f"{name}.lock")
+        self._index = None
+        self._index_mtime = None
+        # One connection shared by the threads of a server process.
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(index_dir / f"{name}.sqlite3", check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS items ("
+            "faiss_id INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT UNIQUE NOT NULL, "
+            "document TEXT, metadata BLOB, source TEXT)"
+        )
+        self._db.commit()
+        self._load_index()
+
+    def _acquire_writer_lock(self, lock_path: Path) -> None:
+        """Block until no other writer has this store open."""
+        self._lock_file = open(lock_path, "a")
+        if fcntl is None:
+            return
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print(f"[INFO] Waiting for another writer to release {lock_path.name}…")
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+
+    def _load_index(self) -> None:
+        """(Re)open the index file if it changed since it was last read."""
+        try:
+            mtime = self.index_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._index_mtime:
+            return
+        self._index = faiss.read_index(str(self.index_path))
+        self._index_mtime = mtime
+
+    def _rows(self, column: str, values) -> list:
+        """Fetch (faiss_id, id, document, metadata) for rows whose column is in values."""
+        values = list(values)
+        rows = []
+        for start in range(0, len(values), SQL_CHUNK):
+            chunk = values[start:start + SQL_CHUNK]
+            placeholders = ",".join("?" * len(chunk))
+            rows.extend(
+                self._db.execute(
+                    f"SELECT faiss_id, id, document, metadata FROM items WHERE {column} IN ({placeholders})",
+                    chunk,
+                )
+            )
+        return rows
+
+    def count(self) -> int:
+        return self._index.ntotal if self._index is not None else 0
+
+    def upsert(self, ids, embeddings, documents=None, metadatas=None) -> None:
+        if self.read_only:
+            raise RuntimeError("FaissStore was opened read-only")
+        vecs = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if self._index is None:
+            self._index = faiss.IndexIDMap2(faiss.IndexFlatIP(vecs.shape[1]))
+        documents = documents or [None] * len(ids)
+        metadatas = metadatas or [None] * len(ids)
+
+        with self._lock:
+            self._delete(ids)
+            rowids = []
+            for doc_id, doc, meta in zip(ids, documents, metadatas):
+                meta = meta or {}
+                cur = self._db.execute(
+                    "INSERT INTO items (id, document, metadata, source) VALUES (?, ?, ?, ?)",
+                    (doc_id, doc, orjson.dumps(meta), meta.get("source")),
+                )
+                rowids.append(cur.lastrowid)
+            self._index.add_with_ids(vecs, np.asarray(rowids, dtype=np.int64))
+
+    add = upsert
+
+    def delete(self, ids) -> None:
+        if self.read_only:
+            raise RuntimeError("FaissStore was opened read-only")
+        with self._lock:
+            self._delete(ids)
+
+    def _delete(self, ids) -> None:
+        rowids = [row[0] for row in self._rows("id", ids)]
+        if not rowids:
+            return
+        if self._index is not None:
+            self._index.remove_ids(np.asarray(rowids, dtype=np.int64))
+        for start in range(0, len(rowids), SQL_CHUNK):
+            chunk = rowids[start:start + SQL_CHUNK]
+            self._db.execute(
+                f"DELETE FROM items WHERE faiss_id IN ({','.join('?' * len(chunk))})", chunk
+            )
+
+    def get(self, ids=None, where=None, include=("documents", "metadatas")) -> dict:
+        """
+        Return stored items like Chroma's collection.get(). `where` supports
+        equality on metadata keys, e.g. {"source": "chatgpt_export"}.
+        """
+        where = dict(where or {})
+        with self._lock:
+            if ids is not None:
+                rows = self._rows("id", ids)
+            elif "source" in where:
+                rows = self._rows("source", [where.pop("source")])
+            else:
+                rows = list(self._db.execute("SELECT faiss_id, id, document, metadata FROM items"))
+
+        result = {"ids": [], "documents": [], "metadatas": []}
+        for _, doc_id, doc, meta in rows:
+            meta = orjson.loads(meta)
+            if any(meta.get(k) != v for k, v in where.items()):
+                continue
+            result["ids"].append(doc_id)
+            result["documents"].append(doc)
+            result["metadatas"].append(meta)
+        for key in ("documents", "metadatas"):
+            if key not in include:
+                result[key] = None
+        return result
+
+    def query(self, query_embeddings, n_results: int = 10) -> dict:
+        """Exact top-n search per query vector, returned in Chroma's nested-list shape."""
+        with self._lock:
+            if self.read_only:
+                self._load_index()
+            index = self._index
+
+        queries = np.ascontiguousarray(query_embeddings, dtype=np.float32)
+        result = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        if index is None or index.ntotal == 0:
+            for key in result:
+                result[key] = [[] for _ in range(len(queries))]
+            return result
+
+        scores, rowids = index.search(queries, min(n_results, index.ntotal))
+        with self._lock:
+            found = {row[0]: row for row in self._rows("faiss_id", {int(r) for r in rowids.flat if r >= 0})}
+
+        for q_scores, q_rowids in zip(scores, rowids):
+            hits = [(found[r], s) for r, s in zip(q_rowids.tolist(), q_scores.tolist()) if r in found]
+            result["ids"].append([row[1] for row, _ in hits])
+            result["documents"].append([row[2] for row, _ in hits])
+            result["metadatas"].append([orjson.loads(row[3]) for row, _ in hits])
+            # Cosine distance, as Chroma reports for a cosine-space collection.
+            result["distances"].append([1.0 - s for _, s in hits])
+        return result
+
+    def save(self) -> None:
+        """Write the index (atomically) and commit the sidecar to disk."""
+        if self.read_only:
+            return
+        with self._lock:
+            if self._index is not None:
+                tmp_path = self.index_path.with_name(self.index_path.name + ".tmp")
+                faiss.write_index(self._index, str(tmp_path))
+                os.replace(tmp_path, self.index_path)
+            self._db.commit()
+
+    def close(self) -> None:
+        """Close the sidecar (dropping anything not saved) and release the writer lock."""
+        with self._lock:
+            self._db.close()
+            if self._lock_file is not None:
+                self._lock_file.close()  # closing the file releases the flock
+                self._lock_file = None